@@ -0,0 +1,290 @@
+import argparse
+import asyncio
+import datetime
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import bot
+
+# load benchmark: starts a server, plays N bot games against it and
+# appends one JSON line per run to a results file
+#
+#   python bench.py --games 200 --workers 4 --label baseline
+#   python bench.py --compare bench_results.jsonl
+#
+# results file: one JSON object per line
+#   format          RESULTS_FORMAT
+#   timestamp       ISO 8601, UTC
+#   label           free text given with --label
+#   server_version  `git describe --always --dirty` of the tree
+#   params          the command line settings of the run
+#   metrics         see collect_metrics(), times in milliseconds
+RESULTS_FORMAT = 1
+DEFAULT_RESULTS = "bench_results.jsonl"
+HERE = os.path.dirname(os.path.abspath(__file__))
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def percentile(values, pct):
+    # nearest-rank percentile, None for an empty list
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def ms(value):
+    return None if value is None else round(value * 1000, 3)
+
+
+def process_tree(pid):
+    # pid plus all of its descendants, read from /proc
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree, todo = [], [pid]
+    while todo:
+        current = todo.pop()
+        tree.append(current)
+        todo.extend(children.get(current, []))
+    return tree
+
+
+def cpu_seconds(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            # utime and stime, fields 14 and 15 of /proc/pid/stat
+            total += int(fields[11]) + int(fields[12])
+        except (OSError, IndexError, ValueError):
+            pass
+    return total / CLOCK_TICKS
+
+
+def rss_bytes(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except (OSError, ValueError):
+            pass
+    return total
+
+
+class ServerMonitor:
+    # samples RSS of the server and its workers while the benchmark runs
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak_rss = max(self.peak_rss, rss_bytes(process_tree(self.pid)))
+            self.stopped.wait(self.interval)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def run_clients(host, port, players, seed, think, spectators, computer):
+    # body of one client process
+    return asyncio.run(bot.play_many(host, port, players, seed, think, spectators, computer))
+
+
+def start_server(port, workers, journal, extra_args):
+    cmd = [sys.executable, os.path.join(HERE, "server.py"), "--port", str(port), "--workers", str(workers),
+           "--journal", journal]
+    server = subprocess.Popen(cmd + extra_args, cwd=HERE, stdout=subprocess.DEVNULL)
+    # wait for the port to open
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("server did not start listening")
+
+
+def collect_metrics(stats, wall, games, server_pid, cpu_before, peak_rss, computer=0):
+    moves = len(stats.move_rtts)
+    metrics = {
+        "games": games,
+        "games_finished": stats.finished if computer else stats.finished // 2,
+        "errors": stats.errors,
+        "moves": moves,
+        "wall_s": round(wall, 3),
+        "moves_per_s": round(moves / wall, 1) if wall else None,
+        "move_rtt_p50_ms": ms(percentile(stats.move_rtts, 50)),
+        "move_rtt_p95_ms": ms(percentile(stats.move_rtts, 95)),
+        "move_rtt_p99_ms": ms(percentile(stats.move_rtts, 99)),
+        "connect_p50_ms": ms(percentile(stats.connect_times, 50)),
+        "connect_p99_ms": ms(percentile(stats.connect_times, 99)),
+        "match_p50_ms": ms(percentile(stats.match_times, 50)),
+        "match_p99_ms": ms(percentile(stats.match_times, 99)),
+        "spectator_frames": stats.spectator_frames,
+        "spectator_syncs": stats.spectator_syncs,
+        "engine_reply_p50_ms": ms(percentile(stats.engine_replies, 50)),
+        "engine_reply_p99_ms": ms(percentile(stats.engine_replies, 99)),
+    }
+    if server_pid is not None:
+        pids = process_tree(server_pid)
+        cpu = cpu_seconds(pids) - cpu_before
+        metrics.update({
+            "server_processes": len(pids),
+            "server_rss_mb": round(rss_bytes(pids) / 2**20, 1),
+            "server_peak_rss_mb": round(peak_rss / 2**20, 1),
+            "server_cpu_s": round(cpu, 3),
+            "server_cpu_ms_per_game": round(cpu * 1000 / games, 3) if games else None,
+            "server_cpu_us_per_move": round(cpu * 1e6 / moves, 1) if moves else None,
+        })
+    return metrics
+
+
+def git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=HERE,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_benchmark(args):
+    server = None
+    server_pid = args.server_pid
+    # a throwaway journal, a later --server-arg=--journal=DIR takes precedence
+    journal = tempfile.mkdtemp(prefix="chess-bench-")
+    if server_pid is None and not args.no_server:
+        server = start_server(args.port, args.workers, journal, args.server_arg)
+        server_pid = server.pid
+    try:
+        monitor = None
+        cpu_before = 0
+        if server_pid is not None:
+            cpu_before = cpu_seconds(process_tree(server_pid))
+            monitor = ServerMonitor(server_pid)
+            monitor.start()
+
+        # split the bots (two per game, one against the computer) evenly across client processes
+        per_game = 1 if args.computer else 2
+        per_proc = [per_game * (args.games // args.client_procs + (i < args.games % args.client_procs))
+                    for i in range(args.client_procs)]
+        jobs = [(args.host, args.port, n, None if args.seed is None else args.seed + i, args.think, args.spectators,
+                 args.computer)
+                for i, n in enumerate(per_proc) if n]
+        start = time.perf_counter()
+        with multiprocessing.get_context("spawn").Pool(len(jobs)) as pool:
+            results = pool.starmap(run_clients, jobs)
+        wall = time.perf_counter() - start
+
+        stats = bot.BotStats()
+        for result in results:
+            stats.merge(result)
+        peak_rss = 0
+        if monitor is not None:
+            monitor.stop()
+            peak_rss = monitor.peak_rss
+        metrics = collect_metrics(stats, wall, args.games, server_pid, cpu_before, peak_rss, args.computer)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        # workers may still be sealing segments as they exit
+        shutil.rmtree(journal, ignore_errors=True)
+
+    return {
+        "format": RESULTS_FORMAT,
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "label": args.label,
+        "server_version": git_version(),
+        "params": {
+            "games": args.games,
+            "workers": None if server is None else args.workers,
+            "client_procs": args.client_procs,
+            "think_s": args.think,
+            "spectators": args.spectators,
+            "computer": args.computer,
+            "server_args": args.server_arg,
+        },
+        "metrics": metrics,
+    }
+
+
+def compare(path, keys):
+    # one row per run in the results file, the selected metrics as columns
+    with open(path) as f:
+        runs = [json.loads(line) for line in f if line.strip()]
+    header = ["timestamp", "label", "version", "workers"] + keys
+    rows = [header]
+    for run in runs:
+        if run.get("format") != RESULTS_FORMAT:
+            continue
+        row = [run["timestamp"], run.get("label") or "", run["server_version"], run["params"].get("workers")]
+        row += [run["metrics"].get(key) for key in keys]
+        rows.append(["" if value is None else str(value) for value in row])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    for row in rows:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chess server load benchmark")
+    parser.add_argument("--games", type=int, default=100, help="concurrent games to play")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="passed to server.py")
+    parser.add_argument("--server-arg", action="append", default=[], help="extra server.py argument, repeatable")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12355)
+    parser.add_argument("--no-server", action="store_true", help="use a server that is already running")
+    parser.add_argument("--server-pid", type=int, help="pid of an already running server to measure")
+    parser.add_argument("--client-procs", type=int, default=1, help="processes running the bots")
+    parser.add_argument("--think", type=float, default=0.0, help="bot delay before each move in seconds")
+    parser.add_argument("--spectators", type=int, default=0, help="watchers per game")
+    parser.add_argument("--computer", type=int, default=0, metavar="LEVEL",
+                        help="every game is a bot against the server's engine at this level")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--label", default="")
+    parser.add_argument("--out", default=DEFAULT_RESULTS, help="results file, one JSON line per run")
+    parser.add_argument("--compare", metavar="RESULTS", help="print the runs stored in a results file and exit")
+    parser.add_argument("--metric", action="append", help="metric column for --compare, repeatable")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.compare, args.metric or ["moves_per_s", "move_rtt_p50_ms", "move_rtt_p99_ms",
+                                              "server_peak_rss_mb", "server_cpu_ms_per_game"])
+        sys.exit(0)
+
+    result = run_benchmark(args)
+    for key, value in result["metrics"].items():
+        print(f"{key:>24}: {value}")
+    with open(args.out, "a") as f:
+        f.write(json.dumps(result) + "\n")
+    print("results appended to", args.out)
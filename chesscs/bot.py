@@ -0,0 +1,144 @@
+import argparse
+import asyncio
+import random
+import time
+
+import chess
+
+import protocol
+
+# headless client that plays random legal moves, used for load testing
+
+
+class BotStats:
+    # timings collected by one or more bots, all in seconds
+    def __init__(self):
+        self.connect_times = []  # TCP connect
+        self.match_times = []    # connect -> COLOR, includes waiting for an opponent
+        self.move_rtts = []      # MOVE sent -> ACK received
+        self.finished = 0        # bots that saw GAME_OVER
+        self.errors = 0
+        self.spectator_frames = 0
+        self.spectator_syncs = 0  # full boards, more than one means it fell behind
+        self.engine_replies = []  # ACK received -> the computer's MOVE received
+
+    def merge(self, other):
+        self.connect_times += other.connect_times
+        self.match_times += other.match_times
+        self.move_rtts += other.move_rtts
+        self.finished += other.finished
+        self.errors += other.errors
+        self.spectator_frames += other.spectator_frames
+        self.spectator_syncs += other.spectator_syncs
+        self.engine_replies += other.engine_replies
+
+
+async def watch(host, port, game_id, stats):
+    # spectate a game until it ends
+    reader, writer = await asyncio.open_connection(host, port)
+    board = chess.Board()
+    try:
+        writer.write(protocol.hello(protocol.MODE_SPECTATE, game_id))
+        await writer.drain()
+        while True:
+            msg_type, fields = await protocol.read_frame(reader)
+            stats.spectator_frames += 1
+            if msg_type == protocol.SYNC:
+                stats.spectator_syncs += 1
+                board.set_fen(fields[0])
+            elif msg_type == protocol.MOVE:
+                board.push(fields[0])
+            elif msg_type in (protocol.GAME_OVER, protocol.REJECT):
+                return board
+    except (asyncio.IncompleteReadError, ConnectionError, protocol.ProtocolError):
+        return board
+    finally:
+        writer.close()
+
+
+async def play(host, port, stats, rng=random, think=0.0, spectators=0, computer=0):
+    # play one game from connect to GAME_OVER, returns the final board;
+    # the white player also brings `spectators` watchers to the game.
+    # with a computer level the bot plays white against the server's engine
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection(host, port)
+    stats.connect_times.append(time.perf_counter() - start)
+    board = chess.Board()
+    try:
+        if computer:
+            writer.write(protocol.hello(protocol.MODE_COMPUTER, 0, computer))
+        else:
+            writer.write(protocol.hello(protocol.MODE_PLAY))
+        await writer.drain()
+        msg_type, fields = await protocol.read_frame(reader)
+        if msg_type != protocol.COLOR:
+            raise protocol.ProtocolError(f"expected COLOR, got {msg_type}")
+        my_color, game_id = fields
+        stats.match_times.append(time.perf_counter() - start)
+        watchers = []
+        if my_color == chess.WHITE:
+            watchers = [asyncio.create_task(watch(host, port, game_id, stats)) for _ in range(spectators)]
+
+        sent_at = None
+        acked_at = None
+        while True:
+            # the GAME_OVER that follows a final move may still be on its way
+            if board.turn == my_color and sent_at is None and board.outcome() is None:
+                if think:
+                    await asyncio.sleep(think)
+                move = rng.choice(list(board.legal_moves))
+                sent_at = time.perf_counter()
+                writer.write(protocol.move(move))
+                await writer.drain()
+            msg_type, fields = await protocol.read_frame(reader)
+            if msg_type == protocol.ACK:
+                acked_at = time.perf_counter()
+                stats.move_rtts.append(acked_at - sent_at)
+                sent_at = None
+                board.push(fields[0])
+            elif msg_type == protocol.MOVE:
+                if computer and acked_at is not None:
+                    stats.engine_replies.append(time.perf_counter() - acked_at)
+                    acked_at = None
+                board.push(fields[0])
+            elif msg_type == protocol.SYNC:
+                board.set_fen(fields[0])
+            elif msg_type == protocol.REJECT:
+                raise protocol.ProtocolError(f"move rejected, reason {fields[0]}")
+            elif msg_type == protocol.GAME_OVER:
+                stats.finished += 1
+                await asyncio.gather(*watchers)
+                return board
+    except (asyncio.IncompleteReadError, ConnectionError, protocol.ProtocolError) as e:
+        print("bot error:", e)
+        stats.errors += 1
+        return board
+    finally:
+        writer.close()
+
+
+async def play_many(host, port, players, seed=None, think=0.0, spectators=0, computer=0):
+    # run `players` bots at once, pairs of them end up in the same game
+    # unless they play the computer
+    stats = BotStats()
+    rng = random.Random(seed)
+    await asyncio.gather(*(play(host, port, stats, random.Random(rng.random()), think, spectators, computer)
+                           for _ in range(players)))
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Random move bot")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--players", type=int, default=1, help="bots to start, two per game")
+    parser.add_argument("--think", type=float, default=0.0, help="seconds to wait before each move")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--spectators", type=int, default=0, help="watchers per game")
+    parser.add_argument("--computer", type=int, default=0, metavar="LEVEL",
+                        help="each bot plays the server's engine at this level")
+    args = parser.parse_args()
+    stats = asyncio.run(play_many(args.host, args.port, args.players, args.seed, args.think, args.spectators,
+                                  args.computer))
+    games = stats.finished if args.computer else stats.finished // 2
+    print(f"{games} games finished, {len(stats.move_rtts)} moves, {stats.errors} errors")
@@ -0,0 +1,123 @@
+import asyncio
+from collections import deque
+
+import protocol
+
+# fan-out of one game's updates to any number of spectators
+#
+# an update is encoded once and the very same bytes object is handed to
+# every subscriber's transport. as long as a spectator keeps up that is a
+# plain non-blocking write, no task and no copy per spectator. once its
+# transport holds WRITE_LIMIT unsent bytes the spectator counts as slow:
+# updates queue up and a drain task feeds them out as the socket allows.
+# past QUEUE_LIMIT queued updates the backlog is dropped and the spectator
+# gets one SYNC of the board as it is by the time it can take data again,
+# so a slow watcher costs a bounded amount of memory and never holds up
+# the players.
+WRITE_LIMIT = 64 * 1024
+QUEUE_LIMIT = 32
+# seconds slow subscribers get to drain their queue once the game is over
+CLOSE_TIMEOUT = 5
+
+
+class Subscriber:
+    def __init__(self, broadcaster, reader, writer):
+        self.broadcaster = broadcaster
+        self.reader = reader
+        self.writer = writer
+        self.transport = writer.transport
+        self.queue = deque()
+        # backlog was dropped, next write is a full snapshot
+        self.needs_snapshot = False
+        self.drainer = None
+        self.watcher = None
+
+    def offer(self, data):
+        if self.needs_snapshot:
+            # the snapshot will already contain this update, the final
+            # GAME_OVER included
+            return
+        if self.drainer is None:
+            if self.transport.is_closing():
+                return
+            if self.transport.get_write_buffer_size() < WRITE_LIMIT:
+                self.transport.write(data)
+                return
+            self.drainer = asyncio.create_task(self.drain())
+        if len(self.queue) >= QUEUE_LIMIT:
+            self.queue.clear()
+            self.needs_snapshot = True
+        else:
+            self.queue.append(data)
+
+    async def drain(self):
+        # runs only while the spectator is behind
+        try:
+            while self.queue or self.needs_snapshot:
+                await self.writer.drain()
+                if self.needs_snapshot:
+                    self.needs_snapshot = False
+                    data = self.broadcaster.snapshot()
+                else:
+                    data = protocol.batch(*self.queue)
+                self.queue.clear()
+                self.writer.write(data)
+        except ConnectionError:
+            self.unsubscribe()
+        finally:
+            self.drainer = None
+
+    async def watch_eof(self):
+        # spectators have nothing to say, anything but EOF is ignored
+        try:
+            while await self.reader.read(1024):
+                pass
+        except ConnectionError:
+            pass
+        self.unsubscribe()
+
+    def unsubscribe(self):
+        self.broadcaster.subscribers.discard(self)
+        for task in (self.drainer, self.watcher):
+            if task is not None and task is not asyncio.current_task():
+                task.cancel()
+        self.writer.close()
+
+
+class Broadcaster:
+    # spectators of one game; snapshot() returns the bytes a late joiner needs
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.subscribers = set()
+        self.closed = False
+
+    def subscribe(self, reader, writer, greeting=b""):
+        if self.closed:
+            # the game just ended, the final board is all there is to see
+            writer.write(greeting + self.snapshot())
+            writer.close()
+            return None
+        subscriber = Subscriber(self, reader, writer)
+        self.subscribers.add(subscriber)
+        subscriber.watcher = asyncio.create_task(subscriber.watch_eof())
+        # greeting and snapshot go out first, updates published later follow
+        subscriber.offer(greeting + self.snapshot())
+        return subscriber
+
+    def publish(self, data):
+        # synchronous on purpose: a spectator subscribing later gets a snapshot
+        # that already contains every update published before it
+        for subscriber in self.subscribers:
+            subscriber.offer(data)
+
+    async def close(self):
+        # give slow subscribers a moment to get the final GAME_OVER, then hang up
+        self.closed = True
+        draining = [s.drainer for s in self.subscribers if s.drainer is not None]
+        if draining:
+            await asyncio.wait(draining, timeout=CLOSE_TIMEOUT)
+        for subscriber in list(self.subscribers):
+            subscriber.unsubscribe()
+
+    def __len__(self):
+        return len(self.subscribers)
@@ -1,29 +1,76 @@
+import argparse
 import socket
+import threading
 import pygame
 import chess
 
+import protocol
+
 # Pygame GUI helper functions
+
+# piece sprites decoded and scaled once, keyed by piece symbol
+# rebuilt whenever SQUARE_SIZE changes
+sprite_cache = {"size": None, "sprites": {}}
+
+
+def get_sprites():
+    if sprite_cache["size"] != SQUARE_SIZE:
+        sprites = {}
+        for symbol in "PNBRQK":
+            for path, key in ((f"../whitePieces/{symbol}.png", symbol),
+                              (f"../blackPieces/{symbol.lower()}.png", symbol.lower())):
+                image = pygame.image.load(path).convert_alpha()
+                sprites[key] = pygame.transform.smoothscale(image, (SQUARE_SIZE, SQUARE_SIZE))
+        sprite_cache["size"] = SQUARE_SIZE
+        sprite_cache["sprites"] = sprites
+    return sprite_cache["sprites"]
+
+
+def square_rect(square):
+    col = chess.square_file(square)
+    row = 7 - chess.square_rank(square)  # Invert row for Pygame
+    return pygame.Rect(col * SQUARE_SIZE, row * SQUARE_SIZE, SQUARE_SIZE, SQUARE_SIZE)
+
+
+def draw_square(board, square, selected_square=None):
+    # paint one square and the piece on it, returns the area that changed
+    rect = square_rect(square)
+    if square == selected_square:
+        color = (255, 255, 100)  # Highlight color (yellow)
+    else:
+        color = WHITE if (chess.square_file(square) + chess.square_rank(square)) % 2 == 1 else BLACK
+    pygame.draw.rect(screen, color, rect)
+    piece = board.piece_at(square)
+    if piece:
+        screen.blit(get_sprites()[piece.symbol()], rect)
+    return rect
+
+
 def draw_board(board, selected_square=None):
-    # draw the chess board
-    for row in range(8):
-        for col in range(8):
-            color = WHITE if (row + col) % 2 == 0 else BLACK
-            if selected_square is not None and selected_square == chess.square(col, 7 - row):
-                color = (255, 255, 100)  # Highlight color (yellow)
-            pygame.draw.rect(screen, color, (col * SQUARE_SIZE, row * SQUARE_SIZE, SQUARE_SIZE, SQUARE_SIZE))
-    
-    # draw pieces
+    # draw the whole chess board, only needed at start or after a full sync
     for square in chess.SQUARES:
-        piece = board.piece_at(square)
-        if piece:
-            if piece.color == chess.WHITE:
-                piece_image = pygame.image.load(f"../whitePieces/{piece.symbol().upper()}.png")
-            else:
-                piece_image = pygame.image.load(f"../blackPieces/{piece.symbol().lower()}.png")
-            piece_image = pygame.transform.scale(piece_image, (SQUARE_SIZE, SQUARE_SIZE))
-            col = chess.square_file(square)
-            row = 7 - chess.square_rank(square)  # Invert row for Pygame
-            screen.blit(piece_image, (col * SQUARE_SIZE, row * SQUARE_SIZE))
+        draw_square(board, square, selected_square)
+    pygame.display.flip()
+
+
+def redraw_squares(board, squares, selected_square=None):
+    # repaint just the given squares and push only those to the display
+    rects = [draw_square(board, square, selected_square) for square in squares]
+    pygame.display.update(rects)
+
+
+def move_squares(board, move):
+    # squares a move changes, must be called before the move is pushed
+    squares = {move.from_square, move.to_square}
+    if board.is_castling(move):
+        rank = chess.square_rank(move.from_square)
+        if chess.square_file(move.to_square) > chess.square_file(move.from_square):
+            squares |= {chess.square(7, rank), chess.square(5, rank)}
+        else:
+            squares |= {chess.square(0, rank), chess.square(3, rank)}
+    elif board.is_en_passant(move):
+        squares.add(chess.square(chess.square_file(move.to_square), chess.square_rank(move.from_square)))
+    return squares
 
 
 def get_square_from_mouse(pos):
@@ -47,80 +94,178 @@ BLACK = (181, 138, 99)
 pygame.init()
 screen = pygame.display.set_mode((BOARD_SIZE, BOARD_SIZE))
 pygame.display.set_caption("Chess Client")
+# redraws are capped at this rate, between events the loop sleeps
+FPS = 30
+# decoded server messages are posted to the pygame queue with this type
+SERVER_EVENT = pygame.event.custom_type()
+
+
+def network_reader(conn):
+    # background thread: turn every server message into a pygame event
+    while True:
+        try:
+            message = conn.recv()
+        except (OSError, protocol.ProtocolError) as e:
+            print("Connection error:", e)
+            message = None
+        if message is None:
+            pygame.event.post(pygame.event.Event(SERVER_EVENT, msg_type=None, fields=None))
+            return
+        msg_type, fields = message
+        pygame.event.post(pygame.event.Event(SERVER_EVENT, msg_type=msg_type, fields=fields))
+
+
+parser = argparse.ArgumentParser(description="Chess client")
+parser.add_argument("--resume", type=int, metavar="GAME_ID", help="rejoin a game after a server restart")
+parser.add_argument("--color", choices=["white", "black"], default="white", help="your color in the resumed or computer game")
+parser.add_argument("--watch", type=int, metavar="GAME_ID", help="watch a running game")
+parser.add_argument("--computer", type=int, metavar="LEVEL", help="play against the computer, level 1 (weakest) to 5")
+args = parser.parse_args()
+
 # socket object
 s = socket.socket()
 
-# your port connection
-port = input("Please select port: ")
-# connect to the server
+# your port connection, every player uses the same port now
+port = input("Please select port (12345): ") or "12345"
+# connect to the server, it pairs us with the next player waiting
 s.connect(('127.0.0.1', int(port)))
-response = s.recv(1024)
-print("Received:", response.decode())
-
-# Get player piece color
-color = response.decode().split()[-1]
+conn = protocol.BlockingConnection(s)
+if args.watch is not None:
+    conn.send(protocol.hello(protocol.MODE_SPECTATE, args.watch))
+elif args.resume is not None:
+    conn.send(protocol.hello(protocol.MODE_RESUME, args.resume, args.color == "white"))
+elif args.computer is not None:
+    # --color picks your side here too
+    conn.send(protocol.hello(protocol.MODE_COMPUTER, 0, args.computer | (protocol.PLAY_BLACK if args.color == "black" else 0)))
+else:
+    conn.send(protocol.hello(protocol.MODE_PLAY))
+print("Waiting for an opponent...")
+pygame.display.set_caption("Chess Client - waiting for an opponent")
 
 board = chess.Board()
 selected_square = None
+color = None
+game_over = False
+# a move was sent and the server has not answered yet
+awaiting_reply = False
 
-server_data = s.recv(1024).decode()
-if "Board:" in server_data:
-    board_str = server_data.split("Board:")[1].strip()
-    board.set_fen(board_str)
-    print("Received initial board state:\n", str(board))
 draw_board(board)
-pygame.display.flip()
+threading.Thread(target=network_reader, args=(conn,), daemon=True).start()
 
-while True:
-    # Receive the initial board state at start of turn
-    print("Turn: ", board.turn)
-    
-
-    if board.turn == (color == "WHITE"): # board.turn is true for white and false for black
-        move = None
-        while move is None:
-        # Handle user input for move
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    pygame.quit()
-                    exit()
-                
-                if event.type == pygame.MOUSEBUTTONDOWN:
-                    clicked_square = get_square_from_mouse(event.pos)
-                    print("Clicked square: ", clicked_square)
-                    if selected_square is None: # First click - select target piece
-                        selected_square = clicked_square
-                    else: # Second click - select target square
-                        print("Move: ", selected_square, "-", clicked_square)
-                        move = chess.Move(selected_square, clicked_square)
-                        if move in board.legal_moves:
-                            s.send(move.uci().encode()) # Send move to the server
-                            response = s.recv(1024).decode()
-                            print("Response: ", response)
-                            if "Move is legal" in response:
-                                board.push(move)
-                        else: # Not a legal move, reset selected square and move
-                            print("Not a legal move")
-                            move = None
-                        selected_square = None
-                    draw_board(board, selected_square)
-                    pygame.display.flip()
+# squares that need repainting on the next refresh()
+dirty = set()
+
+
+def refresh():
+    if dirty:
+        redraw_squares(board, dirty, selected_square)
+        dirty.clear()
+
+
+def my_turn():
+    return color in ("WHITE", "BLACK") and board.turn == (color == "WHITE") # board.turn is true for white and false for black
+
+
+def update_caption():
+    if game_over:
+        status = "game over"
+    elif color is None:
+        status = "waiting for an opponent"
+    elif color == "SPECTATOR":
+        status = "white to move" if board.turn else "black to move"
+    elif my_turn():
+        status = "your move"
     else:
-        board.push(chess.Move.null())
-    
-    # Receive the board state
-    print("Waiting for updated board state...")
-    server_data = s.recv(1024).decode()
-    if "Board:" in server_data:
-        board_str = server_data.split("Board:")[1].strip()
-        board.set_fen(board_str)
-        print("Received updated board state:\n", str(board))
-
-    # Draw the board and update the display after receiving an update from the server
-    draw_board(board)
-    pygame.display.flip()
+        status = "opponent's move"
+    pygame.display.set_caption(f"Chess Client - {color or ''} {status}")
+
 
+def handle_message(msg_type, fields):
+    # apply one server message to the local board
+    global color, game_over, awaiting_reply
+    if msg_type is None:
+        print("Server closed the connection")
+        game_over = True
+    elif msg_type == protocol.COLOR:
+        my_color, game_id = fields
+        if my_color == protocol.SPECTATOR:
+            color = "SPECTATOR"
+            print(f"Watching game {game_id}")
+        else:
+            color = "WHITE" if my_color == chess.WHITE else "BLACK"
+            print(f"You are playing as {color} in game {game_id}")
+    elif msg_type in (protocol.MOVE, protocol.ACK):
+        # only moves come back, not the whole board
+        dirty.update(move_squares(board, fields[0]))
+        board.push(fields[0])
+        if msg_type == protocol.ACK:
+            awaiting_reply = False
+    elif msg_type == protocol.SYNC:
+        board.set_fen(fields[0])
+        dirty.update(chess.SQUARES)
+        print("Received board state:\n", str(board))
+    elif msg_type == protocol.REJECT:
+        if fields[0] == protocol.UNKNOWN_GAME:
+            print("The server does not know that game")
+        elif fields[0] == protocol.UNAVAILABLE:
+            print("The server could not start a game, try again later")
+            game_over = True
+        else:
+            print("Move rejected, reason", fields[0])
+        awaiting_reply = False
+    elif msg_type == protocol.GAME_OVER:
+        winner, termination = fields
+        if winner == protocol.DRAW:
+            print("\nDraw!\nBoard:\n" + str(board))
+        elif color == "SPECTATOR":
+            print("\n" + ("White" if winner == protocol.WINNER_WHITE else "Black") + " wins!\nBoard:\n" + str(board))
+        elif (winner == protocol.WINNER_WHITE) == (color == "WHITE"):
+            print("\nYou Win!\nBoard:\n" + str(board))
+        else:
+            print("\nYou Lose!\nBoard:\n" + str(board))
+        game_over = True
 
 
+def handle_click(pos):
+    global selected_square, awaiting_reply
+    clicked_square = get_square_from_mouse(pos)
+    print("Clicked square: ", clicked_square)
+    # old and new highlight
+    dirty.add(clicked_square)
+    if selected_square is not None:
+        dirty.add(selected_square)
+    if selected_square is None: # First click - select target piece
+        selected_square = clicked_square
+        return
+    # Second click - select target square
+    print("Move: ", selected_square, "-", clicked_square)
+    move = chess.Move(selected_square, clicked_square)
+    if move not in board.legal_moves:
+        # pawns reaching the last rank always become queens
+        move.promotion = chess.QUEEN
+    if move in board.legal_moves:
+        # the server answers with ACK (we push it then) or REJECT
+        conn.send(protocol.move(move)) # Send move to the server
+        awaiting_reply = True
+    else: # Not a legal move, reset selected square
+        print("Not a legal move")
+    selected_square = None
 
 
+clock = pygame.time.Clock()
+while True:
+    # sleep until something happens, then handle everything that is queued
+    events = [pygame.event.wait()] + pygame.event.get()
+    for event in events:
+        if event.type == pygame.QUIT:
+            pygame.quit()
+            exit()
+        elif event.type == SERVER_EVENT:
+            handle_message(event.msg_type, event.fields)
+        elif event.type == pygame.MOUSEBUTTONDOWN:
+            if my_turn() and not awaiting_reply and not game_over:
+                handle_click(event.pos)
+
+    refresh()
+    update_caption()
+    clock.tick(FPS)
@@ -0,0 +1,486 @@
+import argparse
+import asyncio
+import concurrent.futures
+import multiprocessing
+import os
+import time
+
+import chess
+
+import protocol
+from movecache import MoveCache, hash_after, position_hash
+
+# the computer opponent
+#
+# a plain alpha-beta search on top of python-chess' Board:
+#   iterative deepening   depth 1, 2, 3, ... until the time budget or the
+#                         level's depth runs out, the last finished depth wins
+#   transposition table   per engine process and shared by every search it
+#                         runs, keyed like the move cache (Zobrist hash,
+#                         castling rights, en passant square)
+#   move ordering         table move, captures (most valuable victim first),
+#                         two killer moves per ply, then the history heuristic
+#   quiescence search     captures only, so a leaf never stops mid exchange
+#
+# the budget is strict: it starts when the game asks for a move, so time
+# spent waiting for a free engine process is taken out of it, and the
+# search looks at the clock every CHECK_NODES nodes and gives up the
+# unfinished depth as soon as the time is over. searches run in a process
+# pool so they never stall a worker's event loop
+
+# strength level -> (max depth, seconds per move)
+LEVELS = {
+    1: (1, 0.1),
+    2: (2, 0.25),
+    3: (3, 0.5),
+    4: (5, 1.0),
+    5: (64, 2.0),
+}
+DEFAULT_LEVEL = 3
+# nodes between two looks at the clock
+CHECK_NODES = 64
+# kept back from the budget for sending the move back to the worker
+REPLY_MARGIN = 0.005
+# transposition table entries per engine process, cleared when full
+TABLE_SIZE = 500_000
+MAX_PLY = 128
+
+MATE = 100_000
+INFINITY = 1_000_000
+
+PIECE_VALUES = {
+    chess.PAWN: 100,
+    chess.KNIGHT: 320,
+    chess.BISHOP: 330,
+    chess.ROOK: 500,
+    chess.QUEEN: 900,
+    chess.KING: 0,
+}
+
+# piece-square tables from White's point of view, a8 first like a printed board
+PIECE_SQUARES = {
+    chess.PAWN: (
+        0, 0, 0, 0, 0, 0, 0, 0,
+        50, 50, 50, 50, 50, 50, 50, 50,
+        10, 10, 20, 30, 30, 20, 10, 10,
+        5, 5, 10, 25, 25, 10, 5, 5,
+        0, 0, 0, 20, 20, 0, 0, 0,
+        5, -5, -10, 0, 0, -10, -5, 5,
+        5, 10, 10, -20, -20, 10, 10, 5,
+        0, 0, 0, 0, 0, 0, 0, 0,
+    ),
+    chess.KNIGHT: (
+        -50, -40, -30, -30, -30, -30, -40, -50,
+        -40, -20, 0, 0, 0, 0, -20, -40,
+        -30, 0, 10, 15, 15, 10, 0, -30,
+        -30, 5, 15, 20, 20, 15, 5, -30,
+        -30, 0, 15, 20, 20, 15, 0, -30,
+        -30, 5, 10, 15, 15, 10, 5, -30,
+        -40, -20, 0, 5, 5, 0, -20, -40,
+        -50, -40, -30, -30, -30, -30, -40, -50,
+    ),
+    chess.BISHOP: (
+        -20, -10, -10, -10, -10, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 10, 10, 5, 0, -10,
+        -10, 5, 5, 10, 10, 5, 5, -10,
+        -10, 0, 10, 10, 10, 10, 0, -10,
+        -10, 10, 10, 10, 10, 10, 10, -10,
+        -10, 5, 0, 0, 0, 0, 5, -10,
+        -20, -10, -10, -10, -10, -10, -10, -20,
+    ),
+    chess.ROOK: (
+        0, 0, 0, 0, 0, 0, 0, 0,
+        5, 10, 10, 10, 10, 10, 10, 5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        0, 0, 0, 5, 5, 0, 0, 0,
+    ),
+    chess.QUEEN: (
+        -20, -10, -10, -5, -5, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 5, 5, 5, 0, -10,
+        -5, 0, 5, 5, 5, 5, 0, -5,
+        0, 0, 5, 5, 5, 5, 0, -5,
+        -10, 5, 5, 5, 5, 5, 0, -10,
+        -10, 0, 5, 0, 0, 0, 0, -10,
+        -20, -10, -10, -5, -5, -10, -10, -20,
+    ),
+    chess.KING: (
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -20, -30, -30, -40, -40, -30, -30, -20,
+        -10, -20, -20, -20, -20, -20, -20, -10,
+        20, 20, 0, 0, 0, 0, 20, 20,
+        20, 30, 10, 0, 0, 10, 30, 20,
+    ),
+}
+
+# transposition table entry bounds
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+# key -> (depth, score, bound, move), lives as long as the engine process
+_table = {}
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+class SearchResult:
+    __slots__ = ("move", "score", "depth", "nodes", "seconds")
+
+    def __init__(self, move, score, depth, nodes, seconds):
+        self.move = move
+        self.score = score
+        self.depth = depth
+        self.nodes = nodes
+        self.seconds = seconds
+
+    def nps(self):
+        return self.nodes / self.seconds if self.seconds else 0.0
+
+
+def evaluate(board):
+    # material and piece placement, from the side to move's point of view
+    score = 0
+    for piece_type, table in PIECE_SQUARES.items():
+        value = PIECE_VALUES[piece_type]
+        for square in chess.scan_forward(board.pieces_mask(piece_type, chess.WHITE)):
+            score += value + table[square ^ 56]
+        for square in chess.scan_forward(board.pieces_mask(piece_type, chess.BLACK)):
+            score -= value + table[square]
+    return score if board.turn == chess.WHITE else -score
+
+
+def to_table(score, ply):
+    # mate scores are stored relative to the position, not to the root
+    if score > MATE - MAX_PLY:
+        return score + ply
+    if score < -MATE + MAX_PLY:
+        return score - ply
+    return score
+
+
+def from_table(score, ply):
+    if score > MATE - MAX_PLY:
+        return score - ply
+    if score < -MATE + MAX_PLY:
+        return score + ply
+    return score
+
+
+class Searcher:
+    # one search from one position, killers and history live as long as it does
+    def __init__(self, board, max_depth, deadline):
+        # deadline is wall clock time (time.time()), the only clock the
+        # worker and the engine process are sure to share
+        self.board = board
+        self.max_depth = max_depth
+        self.deadline = time.monotonic() + (deadline - time.time())
+        self.nodes = 0
+        self.killers = [[None, None] for _ in range(MAX_PLY + 1)]
+        self.history = {}
+        # positions on the way here, a repetition scores as a draw
+        self.seen = {}
+        self.remember_history()
+
+    def remember_history(self):
+        # the game's positions since the last capture or pawn move
+        board = self.board.copy()
+        for _ in range(min(board.halfmove_clock, len(board.move_stack))):
+            board.pop()
+            key = MoveCache.key(board, position_hash(board))
+            self.seen[key] = self.seen.get(key, 0) + 1
+
+    def tick(self):
+        self.nodes += 1
+        if self.nodes % CHECK_NODES == 0 and time.monotonic() >= self.deadline:
+            raise SearchTimeout()
+
+    def order(self, moves, best, ply):
+        board = self.board
+        killers = self.killers[ply]
+
+        def priority(move):
+            if move == best:
+                return 1 << 30
+            victim = board.piece_type_at(move.to_square)
+            if victim or move.promotion:
+                # most valuable victim, then least valuable attacker
+                return (1 << 25) + 16 * ((victim or 0) + (move.promotion or 0)) - board.piece_type_at(move.from_square)
+            if move in killers:
+                return 1 << 24
+            return self.history.get((move.from_square, move.to_square), 0)
+
+        return sorted(moves, key=priority, reverse=True)
+
+    def quiesce(self, alpha, beta, ply):
+        self.tick()
+        stand_pat = evaluate(self.board)
+        if stand_pat >= beta or ply >= MAX_PLY:
+            return stand_pat
+        alpha = max(alpha, stand_pat)
+        board = self.board
+        captures = list(board.generate_legal_captures())
+        for move in self.order(captures, None, ply):
+            board.push(move)
+            try:
+                score = -self.quiesce(-beta, -alpha, ply + 1)
+            finally:
+                board.pop()
+            if score >= beta:
+                return score
+            alpha = max(alpha, score)
+        return alpha
+
+    def negamax(self, depth, alpha, beta, ply, zobrist):
+        self.tick()
+        board = self.board
+        key = MoveCache.key(board, zobrist)
+        if ply and (board.halfmove_clock >= 100 or key in self.seen):
+            return 0
+        in_check = board.is_check()
+        if in_check:
+            # never stop the search while in check
+            depth += 1
+        if depth <= 0 or ply >= MAX_PLY:
+            return self.quiesce(alpha, beta, ply)
+
+        best_move = None
+        entry = _table.get(key)
+        if entry is not None:
+            entry_depth, score, bound, best_move = entry
+            if ply and entry_depth >= depth:
+                score = from_table(score, ply)
+                if bound == EXACT:
+                    return score
+                if bound == LOWER and score >= beta:
+                    return score
+                if bound == UPPER and score <= alpha:
+                    return score
+
+        moves = list(board.generate_legal_moves())
+        if not moves:
+            return -MATE + ply if in_check else 0
+
+        original_alpha = alpha
+        best_score = -INFINITY
+        self.seen[key] = self.seen.get(key, 0) + 1
+        try:
+            for move in self.order(moves, best_move, ply):
+                child = hash_after(board, zobrist, move)
+                quiet = not board.is_capture(move) and not move.promotion
+                board.push(move)
+                try:
+                    score = -self.negamax(depth - 1, -beta, -alpha, ply + 1, child)
+                finally:
+                    board.pop()
+                if score > best_score:
+                    best_score = score
+                    best_move = move
+                if score > alpha:
+                    alpha = score
+                if alpha >= beta:
+                    if quiet:
+                        killers = self.killers[ply]
+                        if move != killers[0]:
+                            killers[1] = killers[0]
+                            killers[0] = move
+                        square_pair = (move.from_square, move.to_square)
+                        self.history[square_pair] = self.history.get(square_pair, 0) + depth * depth
+                    break
+        finally:
+            self.seen[key] -= 1
+            if not self.seen[key]:
+                del self.seen[key]
+
+        if best_score <= original_alpha:
+            bound = UPPER
+        elif best_score >= beta:
+            bound = LOWER
+        else:
+            bound = EXACT
+        if len(_table) >= TABLE_SIZE:
+            _table.clear()
+        _table[key] = (depth, to_table(best_score, ply), bound, best_move)
+        return best_score
+
+    def root(self, depth, zobrist, previous):
+        # negamax at ply 0, keeps whatever it has when time runs out: the
+        # previous best move is searched first, so anything that beats it
+        # is at least as good as the result of the last full depth
+        board = self.board
+        best_move, best_score = None, -INFINITY
+        alpha = -INFINITY
+        try:
+            for move in self.order(list(board.generate_legal_moves()), previous, 0):
+                child = hash_after(board, zobrist, move)
+                board.push(move)
+                try:
+                    score = -self.negamax(depth - 1, -INFINITY, -alpha, 1, child)
+                finally:
+                    board.pop()
+                if score > best_score:
+                    best_move, best_score = move, score
+                    alpha = max(alpha, score)
+        except SearchTimeout:
+            return best_move, best_score, False
+        return best_move, best_score, True
+
+    def search(self):
+        start = time.monotonic()
+        zobrist = position_hash(self.board)
+        entry = _table.get(MoveCache.key(self.board, zobrist))
+        best_move = entry[3] if entry is not None else None
+        best_score, finished = 0, 0
+        for depth in range(1, self.max_depth + 1):
+            move, score, complete = self.root(depth, zobrist, best_move)
+            if move is not None:
+                best_move, best_score = move, score
+            if not complete:
+                break
+            finished = depth
+            if abs(score) > MATE - MAX_PLY:
+                break
+            # the next depth takes several times as long, don't start what can't finish
+            if time.monotonic() - start > (self.deadline - start) / 2:
+                break
+        if best_move is None:
+            # out of time before the first move was searched
+            best_move = self.order(list(self.board.generate_legal_moves()), None, 0)[0]
+        return SearchResult(best_move, best_score, finished, self.nodes, time.monotonic() - start)
+
+
+def search(board, level=DEFAULT_LEVEL, deadline=None):
+    # best move for the side to move, runs inside an engine process;
+    # the board keeps its move stack so repetitions are seen. past the
+    # deadline already the move comes from move ordering alone
+    max_depth, budget = LEVELS[level]
+    if deadline is None:
+        deadline = time.time() + budget
+    return Searcher(board, max_depth, deadline - REPLY_MARGIN).search()
+
+
+def default_processes(workers):
+    # searches are CPU bound, so by default all workers together get one
+    # engine process per core; more only slices the same cores thinner
+    return max(1, (os.cpu_count() or 1) // max(1, workers))
+
+
+def warm_up():
+    # runs once in every new engine process, importing this module is the point
+    pass
+
+
+class EnginePool:
+    # engine processes shared by every computer game of a worker
+    def __init__(self, processes=1):
+        self.processes = processes
+        self.executor = None
+        self.started = None
+        self.searches = 0
+        self.nodes = 0
+        self.search_seconds = 0.0
+        # time between handing a search to the pool and getting the move back,
+        # past the search itself: queueing behind other games plus pickling
+        self.wait_seconds = 0.0
+        self.depths = 0
+        # moves that came back after their budget, and searches that ran out
+        # of time before finishing depth 1; either means more processes
+        self.late = 0
+        self.starved = 0
+
+    async def start(self):
+        # bring every engine process up before a game needs a move, so
+        # starting them never eats into a move's budget
+        if self.started is None:
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                self.processes, mp_context=multiprocessing.get_context("spawn"))
+            loop = asyncio.get_running_loop()
+            self.started = asyncio.gather(*(loop.run_in_executor(self.executor, warm_up)
+                                            for _ in range(self.processes)))
+        await self.started
+
+    async def best_move(self, board, level):
+        await self.start()
+        loop = asyncio.get_running_loop()
+        budget = LEVELS[level][1]
+        start = time.perf_counter()
+        result = await loop.run_in_executor(self.executor, search, board.copy(), level, time.time() + budget)
+        elapsed = time.perf_counter() - start
+        self.searches += 1
+        self.nodes += result.nodes
+        self.search_seconds += result.seconds
+        self.wait_seconds += max(0.0, elapsed - result.seconds)
+        self.depths += result.depth
+        self.late += elapsed > budget
+        self.starved += result.depth == 0
+        return result.move
+
+    def summary(self):
+        if not self.searches:
+            return "engine idle"
+        nps = self.nodes / self.search_seconds if self.search_seconds else 0.0
+        return (f"engine {self.searches} searches, {self.nodes} nodes, {nps:.0f} nps, "
+                f"depth {self.depths / self.searches:.1f}, "
+                f"{self.wait_seconds / self.searches * 1000:.1f} ms queued per search, "
+                f"{self.late} late, {self.starved} short of depth 1 "
+                f"({self.processes} processes)")
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+
+async def play_computer(pool, level, reader, writer, resumed=False):
+    # the computer's side of a game, speaks the protocol like any client.
+    # a resumed game sends COLOR and then SYNC, wait for the board first
+    board = chess.Board()
+    my_color = None
+    synced = not resumed
+    try:
+        while True:
+            msg_type, fields = await protocol.read_frame(reader)
+            if msg_type == protocol.COLOR:
+                my_color = fields[0]
+            elif msg_type in (protocol.MOVE, protocol.ACK):
+                board.push(fields[0])
+            elif msg_type == protocol.SYNC:
+                # a resumed game only knows the position, not how it got there
+                board.set_fen(fields[0])
+                synced = True
+            elif msg_type in (protocol.GAME_OVER, protocol.REJECT):
+                return
+            if synced and board.turn == my_color and board.outcome() is None:
+                writer.write(protocol.move(await pool.best_move(board, level)))
+                await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError, protocol.ProtocolError):
+        pass
+    finally:
+        writer.close()
+
+
+if __name__ == "__main__":
+    # measure the engine on one position, e.g. to size --engine-procs
+    parser = argparse.ArgumentParser(description="Search one position")
+    parser.add_argument("fen", nargs="?", default=chess.STARTING_FEN)
+    parser.add_argument("--level", type=int, choices=sorted(LEVELS), default=DEFAULT_LEVEL)
+    parser.add_argument("--moves", type=int, default=1, help="play this many moves from the position")
+    args = parser.parse_args()
+
+    board = chess.Board(args.fen)
+    for _ in range(args.moves):
+        if board.outcome() is not None:
+            break
+        result = search(board, args.level)
+        print(f"{board.san(result.move)}: score {result.score}, depth {result.depth}, "
+              f"{result.nodes} nodes in {result.seconds:.3f}s, {result.nps():.0f} nps")
+        board.push(result.move)
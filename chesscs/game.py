@@ -0,0 +1,182 @@
+import asyncio
+
+import chess
+
+import protocol
+from broadcast import Broadcaster
+from movecache import CachedBoard, MoveCache
+
+
+class GameSession:
+    # one running game: its own board plus the two player connections
+    def __init__(self, game_id, white, black, cache=None, journal=None, board=None, computer=0):
+        self.game_id = game_id
+        # HELLO argument of a game against the computer, journaled with START
+        self.computer = computer
+        self.board = board if board is not None else chess.Board()
+        # accepted moves are made durable here before anyone hears about them
+        self.journal = journal
+        # legality and game-over checks go through the worker's shared cache
+        self.position = CachedBoard(self.board, cache if cache is not None else MoveCache(0))
+        # (reader, writer) stream pairs, indexed by chess.WHITE / chess.BLACK
+        self.players = {chess.WHITE: white, chess.BLACK: black}
+        # frames from both players end up here as (color, type, fields)
+        self.inbox = asyncio.Queue()
+        # the GAME_OVER frame once the game has ended
+        self.over = None
+        # everyone watching, late joiners start from a full board
+        self.spectators = Broadcaster(self.snapshot)
+
+    def reader(self, color):
+        return self.players[color][0]
+
+    def writer(self, color):
+        return self.players[color][1]
+
+    def snapshot(self):
+        # what a spectator needs to catch up: the board, and the result if
+        # there is one since a FEN cannot tell how (or whether) the game ended
+        return protocol.sync(self.board.fen()) + (self.over or b"")
+
+    def end(self, winner, termination):
+        self.over = protocol.game_over(winner, termination)
+        return self.over
+
+    def watch(self, reader, writer):
+        self.spectators.subscribe(reader, writer, protocol.color(protocol.SPECTATOR, self.game_id))
+
+    def send(self, color, *frames):
+        writer = self.writer(color)
+        if not writer.is_closing():
+            writer.write(protocol.batch(*frames))
+
+    async def flush(self):
+        for color in (chess.WHITE, chess.BLACK):
+            writer = self.writer(color)
+            if not writer.is_closing():
+                try:
+                    await writer.drain()
+                except ConnectionError:
+                    pass
+
+    async def listen(self, color):
+        # forward everything a player sends into the inbox, None means they left
+        try:
+            while True:
+                msg_type, payload = await protocol.read_raw_frame(self.reader(color))
+                try:
+                    fields = protocol.decode(msg_type, payload)
+                except protocol.ProtocolError:
+                    # the whole frame was read, so the player can simply try again
+                    self.send(color, protocol.reject(protocol.WRONG_FORMAT))
+                    continue
+                await self.inbox.put((color, msg_type, fields))
+        except protocol.ProtocolError:
+            # a bad header, there is no telling where the next frame starts
+            self.send(color, protocol.reject(protocol.WRONG_FORMAT))
+            await self.inbox.put((color, None, None))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            await self.inbox.put((color, None, None))
+
+    async def record(self, method, *args):
+        if self.journal is not None:
+            await getattr(self.journal, method)(self.game_id, *args)
+
+    async def close(self):
+        for color in (chess.WHITE, chess.BLACK):
+            writer = self.writer(color)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+def color_name(color):
+    return "WHITE" if color == chess.WHITE else "BLACK"
+
+
+async def play_game(session, resumed=False):
+    board = session.board
+    listeners = []
+    try:
+        if resumed:
+            # a game rebuilt from the journal, both players get the full board once
+            print(f"[game {session.game_id}] resumed at ply {board.ply()}")
+            state = protocol.sync(board.fen())
+            session.send(chess.WHITE, protocol.color(chess.WHITE, session.game_id), state)
+            session.send(chess.BLACK, protocol.color(chess.BLACK, session.game_id), state)
+        else:
+            print(f"[game {session.game_id}] started")
+            await session.record("start_game", session.computer)
+            session.send(chess.WHITE, protocol.color(chess.WHITE, session.game_id))
+            session.send(chess.BLACK, protocol.color(chess.BLACK, session.game_id))
+        await session.flush()
+
+        listeners = [asyncio.create_task(session.listen(color)) for color in (chess.WHITE, chess.BLACK)]
+
+        # game running until it ends
+        while True:
+            color, msg_type, fields = await session.inbox.get()
+            if msg_type is None:
+                # stopping when connection ends, the player left is the winner
+                print(f"[game {session.game_id}] {color_name(color)} disconnected")
+                winner = protocol.WINNER_BLACK if color == chess.WHITE else protocol.WINNER_WHITE
+                await session.record("end_game", board.ply(), winner, protocol.ABANDONED)
+                over = session.end(winner, protocol.ABANDONED)
+                session.send(not color, over)
+                session.spectators.publish(over)
+                break
+            if msg_type != protocol.MOVE:
+                session.send(color, protocol.reject(protocol.WRONG_FORMAT))
+                await session.flush()
+                continue
+            if color != board.turn:
+                session.send(color, protocol.reject(protocol.NOT_YOUR_TURN))
+                await session.flush()
+                continue
+
+            (move,) = fields
+            if not session.position.is_legal(move):
+                session.send(color, protocol.reject(protocol.ILLEGAL_MOVE))
+                await session.flush()
+                continue
+
+            # only the move itself goes out, both sides apply it to their own board
+            await session.record("move", board.ply(), move)
+            session.position.push(move)
+            mover_frames = [protocol.ack(move)]
+            other_frames = [protocol.move(move)]
+            outcome = session.position.outcome()
+            if outcome is not None:
+                winner = protocol.winner_code(outcome)
+                await session.record("end_game", board.ply(), winner, outcome.termination.value)
+                over = session.end(winner, outcome.termination.value)
+                mover_frames.append(over)
+                other_frames.append(over)
+            # the opponent's update is encoded once and reused for every spectator,
+            # the players' bytes are handed to their sockets first
+            update = protocol.batch(*other_frames)
+            session.send(color, *mover_frames)
+            session.send(not color, update)
+            session.spectators.publish(update)
+            await session.flush()
+            if outcome is not None:
+                break
+    except ConnectionError:
+        print(f"[game {session.game_id}] connection lost")
+    except OSError as e:
+        # the journal failed, a move nobody can replay must not be played;
+        # the game ends without a result for both sides
+        print(f"[game {session.game_id}] journal error: {e}")
+        over = session.end(protocol.DRAW, protocol.ABANDONED)
+        session.send(chess.WHITE, over)
+        session.send(chess.BLACK, over)
+        session.spectators.publish(over)
+    finally:
+        for task in listeners:
+            task.cancel()
+        await session.flush()
+        await session.close()
+        await session.spectators.close()
+        print(f"[game {session.game_id}] finished after {board.ply()} plies")
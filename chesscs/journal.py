@@ -0,0 +1,496 @@
+import argparse
+import asyncio
+from array import array
+import concurrent.futures
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+
+import chess
+import chess.pgn
+
+import protocol
+
+# append-only game journal
+#
+# every accepted move is written to the current segment file before the
+# mover gets its ACK. appends are grouped: while one batch is being written
+# and fsync'ed, new records queue up and go out together in the next one,
+# so a busy worker pays for one fsync per batch instead of one per move.
+#
+# a journal directory holds numbered segments
+#   00000001.seg  8 byte MAGIC, then fixed size records
+#   00000001.idx  written when the segment is sealed: INDEX_MAGIC, the
+#                 number of games, INDEX_ENTRY rows sorted by game id, then
+#                 the offsets of every game's records, so a game is found by
+#                 binary search over an mmap of the file and read back
+#                 without touching the records of the other games
+#
+# record (RECORD, 21 bytes)
+#   kind      u8   START, MOVE or END
+#   game id   u32
+#   ply       u16  ply the record belongs to (for MOVE the ply before the move)
+#   value     u16  MOVE: protocol.encode_move(), END: winner << 8 | termination,
+#                  START: 0, or for a game against the computer the HELLO
+#                  argument (level, plus protocol.PLAY_BLACK if the human is black)
+#   timestamp f64  unix time
+#   crc       u32  crc32 of the fields above, a torn tail fails this check
+MAGIC = b"CHESSJ1\n"
+RECORD = struct.Struct("!BIHHdI")
+_RECORD_BODY = struct.Struct("!BIHHd")
+INDEX_MAGIC = b"CHESSX2\n"
+INDEX_HEADER = struct.Struct("!I")
+# game id, first slot in the offset table, number of records, flags (START/END seen)
+INDEX_ENTRY = struct.Struct("!IIIB3x")
+
+START = 1
+MOVE = 2
+END = 3
+
+FLAG_STARTED = 1
+FLAG_ENDED = 2
+
+DEFAULT_SEGMENT_SIZE = 64 * 2**20
+
+
+def pack_record(kind, game_id, ply, value, timestamp):
+    body = _RECORD_BODY.pack(kind, game_id, ply, value, timestamp)
+    return body + struct.pack("!I", zlib.crc32(body))
+
+
+def segment_path(directory, number, ext="seg"):
+    return os.path.join(directory, f"{number:08d}.{ext}")
+
+
+def list_segments(directory):
+    numbers = []
+    for name in os.listdir(directory):
+        stem, ext = os.path.splitext(name)
+        if ext == ".seg" and stem.isdigit():
+            numbers.append(int(stem))
+    return sorted(numbers)
+
+
+def unpack_record(data):
+    # (kind, game_id, ply, value, timestamp), None for a torn or corrupt record
+    if len(data) < RECORD.size:
+        return None
+    kind, game_id, ply, value, timestamp, crc = RECORD.unpack(data)
+    if zlib.crc32(data[:_RECORD_BODY.size]) != crc:
+        return None
+    return kind, game_id, ply, value, timestamp
+
+
+def scan_segment(path):
+    # yields (offset, kind, game_id, ply, value, timestamp) up to the first bad record
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            return
+        offset = len(MAGIC)
+        while True:
+            record = unpack_record(f.read(RECORD.size))
+            if record is None:
+                return
+            yield (offset,) + record
+            offset += RECORD.size
+
+
+def read_records(path, offsets):
+    # the records at the given (ascending) offsets, one seek each
+    with open(path, "rb") as f:
+        for offset in offsets:
+            f.seek(offset)
+            record = unpack_record(f.read(RECORD.size))
+            if record is None:
+                return
+            yield record
+
+
+def add_to_index(index, offset, kind, game_id):
+    entry = index.get(game_id)
+    if entry is None:
+        entry = index[game_id] = [array("I"), 0]
+    entry[0].append(offset)
+    if kind == START:
+        entry[1] |= FLAG_STARTED
+    elif kind == END:
+        entry[1] |= FLAG_ENDED
+
+
+def index_bytes(index):
+    rows = []
+    offsets = array("I")
+    for game_id in sorted(index):
+        game_offsets, flags = index[game_id]
+        rows.append(INDEX_ENTRY.pack(game_id, len(offsets), len(game_offsets), flags))
+        offsets.extend(game_offsets)
+    if sys.byteorder == "little":
+        offsets.byteswap()
+    return INDEX_MAGIC + INDEX_HEADER.pack(len(rows)) + b"".join(rows) + offsets.tobytes()
+
+
+def write_index(directory, number, index):
+    path = segment_path(directory, number, "idx")
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(index_bytes(index))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class SegmentIndex:
+    # read-only view of a sealed segment's .idx file, or of an index that
+    # was just rebuilt in memory (data)
+    def __init__(self, path=None, data=None):
+        self.file = None
+        if data is not None:
+            self.map = data
+        else:
+            self.file = open(path, "rb")
+            if os.path.getsize(path):
+                self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.map = b""
+        # an index from an older version (or cut short) counts as missing
+        self.valid = self.map[:len(INDEX_MAGIC)] == INDEX_MAGIC
+        self.count = 0
+        if self.valid:
+            (self.count,) = INDEX_HEADER.unpack_from(self.map, len(INDEX_MAGIC))
+        self.rows_start = len(INDEX_MAGIC) + INDEX_HEADER.size
+        self.offsets_start = self.rows_start + self.count * INDEX_ENTRY.size
+
+    def entry(self, i):
+        return INDEX_ENTRY.unpack_from(self.map, self.rows_start + i * INDEX_ENTRY.size)
+
+    def offsets(self, first, count):
+        # record offsets of one game, in file order
+        return struct.unpack_from(f"!{count}I", self.map, self.offsets_start + first * 4)
+
+    def lookup(self, game_id):
+        # (record offsets, flags) or None
+        # binary search by hand, bisect only takes a key from Python 3.10 on
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entry(mid)[0] < game_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        i = lo
+        if i < self.count:
+            found, first, count, flags = self.entry(i)
+            if found == game_id:
+                return self.offsets(first, count), flags
+        return None
+
+    def __iter__(self):
+        # (game id, first, count, flags) rows
+        for i in range(self.count):
+            yield self.entry(i)
+
+    def close(self):
+        if self.file is not None:
+            if self.map:
+                self.map.close()
+            self.file.close()
+
+
+def load_index(directory, number, persist=False):
+    # index of a segment; segments without one (still being written, or left
+    # open by a crash) are scanned. persist seals such a segment for good and
+    # is only safe for the owner of the directory while nothing writes to it
+    path = segment_path(directory, number, "idx")
+    if os.path.exists(path):
+        index = SegmentIndex(path)
+        if index.valid:
+            return index
+        index.close()
+    index = {}
+    for offset, kind, game_id, *_ in scan_segment(segment_path(directory, number)):
+        add_to_index(index, offset, kind, game_id)
+    if persist:
+        write_index(directory, number, index)
+    return SegmentIndex(data=index_bytes(index))
+
+
+def read_game(root, game_id):
+    # all records of one game, in order, as (kind, ply, value, timestamp);
+    # a game can be spread over the directories of several workers
+    records = []
+    for directory in journal_dirs(root):
+        for number in list_segments(directory):
+            index = load_index(directory, number)
+            try:
+                found = index.lookup(game_id)
+            finally:
+                index.close()
+            if found is None:
+                continue
+            offsets, _ = found
+            for kind, _, ply, value, timestamp in read_records(segment_path(directory, number), offsets):
+                records.append((kind, ply, value, timestamp))
+    return sort_records(records)
+
+
+def sort_records(records):
+    records.sort(key=lambda record: (record[1], record[0]))
+    return records
+
+
+def board_from_records(records):
+    board = chess.Board()
+    for kind, ply, value, _ in records:
+        if kind == MOVE and ply == board.ply():
+            board.push(protocol.decode_move(value))
+    return board
+
+
+def game_to_pgn(game_id, records):
+    game = chess.pgn.Game.from_board(board_from_records(records))
+    game.headers["Event"] = f"Game {game_id}"
+    game.headers["Site"] = "chesscs"
+    if records:
+        game.headers["Date"] = time.strftime("%Y.%m.%d", time.gmtime(records[0][3]))
+    for kind, _, value, _ in records:
+        if kind == END:
+            winner = value >> 8
+            game.headers["Result"] = {protocol.WINNER_WHITE: "1-0", protocol.WINNER_BLACK: "0-1"}.get(winner, "1/2-1/2")
+            if value & 0xFF == protocol.ABANDONED:
+                game.headers["Termination"] = "abandoned"
+    return str(game)
+
+
+class JournalWriter:
+    # the file side of the journal, only ever used from one thread
+    def __init__(self, directory, segment_size):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.number = 0
+        self.file = None
+        self.offset = 0
+        self.index = {}
+
+    def open_segment(self, number):
+        self.number = number
+        self.file = open(segment_path(self.directory, number), "wb")
+        self.file.write(MAGIC)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        # make the new file itself durable
+        dir_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        self.offset = len(MAGIC)
+        self.index = {}
+
+    def seal(self):
+        self.file.close()
+        write_index(self.directory, self.number, self.index)
+
+    def write_batch(self, records):
+        if self.file is None:
+            raise OSError("journal segment unavailable after an earlier error")
+        data = b"".join(pack_record(*record) for record in records)
+        try:
+            self.file.write(data)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        except OSError:
+            try:
+                self.rewind()
+            except OSError:
+                # not even that worked, every later batch fails too
+                self.file = None
+            raise
+        # only records that are on disk go into the index
+        for i, record in enumerate(records):
+            add_to_index(self.index, self.offset + i * RECORD.size, record[0], record[1])
+        self.offset += len(data)
+        if self.offset >= self.segment_size:
+            try:
+                self.seal()
+                self.open_segment(self.number + 1)
+            except OSError as e:
+                # this batch is durable, the next one will report the problem
+                print(f"journal: could not start a new segment: {e}", file=sys.stderr)
+                self.file = None
+
+    def rewind(self):
+        # cut off whatever part of a failed batch reached the file, so the
+        # segment holds exactly the records the index knows about
+        file, self.file = self.file, None
+        try:
+            file.close()
+        except OSError:
+            pass
+        file = open(segment_path(self.directory, self.number), "r+b")
+        try:
+            file.truncate(self.offset)
+            file.seek(self.offset)
+            os.fsync(file.fileno())
+        except OSError:
+            file.close()
+            raise
+        self.file = file
+
+    def close(self):
+        if self.file is not None:
+            self.seal()
+            self.file = None
+
+
+class RecoveredGame:
+    def __init__(self, game_id, records):
+        self.game_id = game_id
+        self.records = records
+        self.board = board_from_records(records)
+        # 0 for two players, else who the computer is and how strong
+        self.computer = next((value for kind, _, value, _ in records if kind == START), 0)
+
+
+def recover(root, own_dir=None, share=None):
+    # live games (started, not ended) and the highest game id seen.
+    # share(game_id) picks the games the caller wants rebuilt, the others
+    # only count for the highest id. own_dir gets its crashed segments
+    # sealed on the way.
+    #
+    # the flags come from the indexes alone; after that each segment is
+    # opened once and only the records of the wanted live games are read
+    indexes = []
+    flags = {}
+    try:
+        for directory in journal_dirs(root):
+            for number in list_segments(directory):
+                index = load_index(directory, number, persist=directory == own_dir)
+                indexes.append((segment_path(directory, number), index))
+                for game_id, _, _, game_flags in index:
+                    flags[game_id] = flags.get(game_id, 0) | game_flags
+        live = {game_id for game_id, game_flags in flags.items()
+                if game_flags == FLAG_STARTED and (share is None or share(game_id))}
+        records = {game_id: [] for game_id in live}
+        for path, index in indexes:
+            offsets = []
+            for game_id, first, count, _ in index:
+                if game_id in live:
+                    offsets.extend(index.offsets(first, count))
+            offsets.sort()
+            for kind, game_id, ply, value, timestamp in read_records(path, offsets):
+                records[game_id].append((kind, ply, value, timestamp))
+    finally:
+        for _, index in indexes:
+            index.close()
+    games = {game_id: RecoveredGame(game_id, sort_records(records[game_id])) for game_id in live}
+    return games, max(flags, default=0)
+
+
+class Journal:
+    # asyncio facade: append() returns once the record is on disk
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.writer = JournalWriter(directory, segment_size)
+        self.executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="journal")
+        self.pending = []
+        self.waiters = []
+        self.flushing = False
+        self.batches = 0
+        self.records = 0
+
+    def open(self, root, share=None):
+        # recover our share of the games under root and start a fresh segment
+        # in our own directory, returns recover()
+        os.makedirs(self.directory, exist_ok=True)
+        for name in os.listdir(self.directory):
+            # an index write cut short by a crash
+            if name.endswith(".tmp"):
+                os.remove(os.path.join(self.directory, name))
+        recovered = recover(root, self.directory, share)
+        segments = list_segments(self.directory)
+        self.writer.open_segment(segments[-1] + 1 if segments else 1)
+        return recovered
+
+    async def append(self, kind, game_id, ply, value=0):
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self.pending.append((kind, game_id, ply, value, time.time()))
+        self.waiters.append(waiter)
+        if not self.flushing:
+            self.flushing = True
+            loop.create_task(self.flush_loop())
+        await waiter
+
+    async def flush_loop(self):
+        # group commit: everything queued while the last fsync ran goes next
+        loop = asyncio.get_running_loop()
+        try:
+            while self.pending:
+                records, waiters = self.pending, self.waiters
+                self.pending, self.waiters = [], []
+                try:
+                    await loop.run_in_executor(self.executor, self.writer.write_batch, records)
+                except OSError as e:
+                    for waiter in waiters:
+                        if not waiter.done():
+                            waiter.set_exception(e)
+                    continue
+                self.batches += 1
+                self.records += len(records)
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(None)
+        finally:
+            self.flushing = False
+
+    def start_game(self, game_id, computer=0):
+        return self.append(START, game_id, 0, computer)
+
+    def move(self, game_id, ply, move):
+        return self.append(MOVE, game_id, ply, protocol.encode_move(move))
+
+    def end_game(self, game_id, ply, winner, termination):
+        return self.append(END, game_id, ply, (winner << 8) | termination)
+
+    def summary(self):
+        per_batch = self.records / self.batches if self.batches else 0
+        return f"journal {self.records} records in {self.batches} fsyncs ({per_batch:.1f} per fsync)"
+
+    def close(self):
+        self.executor.submit(self.writer.close).result()
+        self.executor.shutdown()
+
+
+def journal_dirs(root):
+    # a server journal root holds one directory per worker
+    if not os.path.isdir(root):
+        return []
+    if list_segments(root):
+        return [root]
+    return [os.path.join(root, name) for name in sorted(os.listdir(root))
+            if os.path.isdir(os.path.join(root, name))]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect a game journal")
+    parser.add_argument("root", help="journal directory given to server.py")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("live", help="list games that have not ended")
+    pgn = commands.add_parser("pgn", help="export one game as PGN")
+    pgn.add_argument("game_id", type=int)
+    args = parser.parse_args()
+
+    if args.command == "live":
+        games, _ = recover(args.root)
+        for game in games.values():
+            print(f"game {game.game_id}, {game.board.ply()} plies, {game.board.fen()}")
+    elif args.command == "pgn":
+        records = read_game(args.root, args.game_id)
+        if not records:
+            print(f"game {args.game_id} not found", file=sys.stderr)
+            sys.exit(1)
+        print(game_to_pgn(args.game_id, records))
@@ -0,0 +1,167 @@
+from array import array
+from collections import OrderedDict
+
+import chess
+import chess.polyglot
+
+from protocol import encode_move
+
+# legal moves and game status per position, shared by every game of a worker
+#
+# most games walk through the same openings, so instead of letting
+# python-chess generate the legal moves of a position again for each game
+# we remember them, keyed by the position's Zobrist hash
+DEFAULT_CACHE_SIZE = 100_000
+# past this ply positions are almost never shared between games, a lookup
+# would only cost a hash update and a full move generation for nothing
+DEFAULT_CACHE_PLIES = 30
+
+_RANDOM = chess.polyglot.POLYGLOT_RANDOM_ARRAY
+_HASHER = chess.polyglot.ZobristHasher(_RANDOM)
+
+
+def position_hash(board):
+    # polyglot Zobrist hash of the pieces and the side to move; castling and
+    # en passant go into the cache key as they are (see MoveCache.key)
+    return _HASHER.hash_board(board) ^ _HASHER.hash_turn(board)
+
+
+def _piece_key(piece_type, color, square):
+    return _RANDOM[64 * ((piece_type - 1) * 2 + int(color)) + square]
+
+
+def hash_after(board, zobrist, move):
+    # position_hash() after `move`, updated incrementally; call before pushing.
+    # the full hash costs more than the legal move check it is meant to save
+    piece_type = board.piece_type_at(move.from_square)
+    color = board.turn
+    zobrist ^= _piece_key(piece_type, color, move.from_square)
+    zobrist ^= _piece_key(move.promotion or piece_type, color, move.to_square)
+    if board.is_en_passant(move):
+        victim = move.to_square - 8 if color == chess.WHITE else move.to_square + 8
+        zobrist ^= _piece_key(chess.PAWN, not color, victim)
+    elif board.is_castling(move):
+        rank = chess.square_rank(move.from_square)
+        if chess.square_file(move.to_square) > chess.square_file(move.from_square):
+            rook_from, rook_to = chess.square(7, rank), chess.square(5, rank)
+        else:
+            rook_from, rook_to = chess.square(0, rank), chess.square(3, rank)
+        zobrist ^= _piece_key(chess.ROOK, color, rook_from) ^ _piece_key(chess.ROOK, color, rook_to)
+    else:
+        captured = board.piece_type_at(move.to_square)
+        if captured:
+            zobrist ^= _piece_key(captured, not color, move.to_square)
+    return zobrist ^ _RANDOM[780]
+
+
+class PositionInfo:
+    __slots__ = ("legal", "outcome")
+
+    def __init__(self, legal, outcome):
+        # encoded moves (protocol.encode_move), an array keeps entries small
+        self.legal = legal
+        # checkmate / stalemate / insufficient material, None otherwise.
+        # repetition and move-count draws depend on the game history, not
+        # the position, so they are never cached
+        self.outcome = outcome
+
+    def is_legal(self, move):
+        return encode_move(move) in self.legal
+
+
+class MoveCache:
+    # bounded LRU of PositionInfo, max_size 0 turns caching off
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE, max_ply=DEFAULT_CACHE_PLIES):
+        self.max_size = max_size
+        self.max_ply = max_ply
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def wants(self, board):
+        return self.max_size > 0 and board.ply() <= self.max_ply
+
+    @staticmethod
+    def key(board, zobrist):
+        return zobrist, board.castling_rights, board.ep_square
+
+    def lookup(self, board, zobrist):
+        key = self.key(board, zobrist)
+        info = self.entries.get(key)
+        if info is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return info
+        self.misses += 1
+        info = self.compute(board)
+        self.entries[key] = info
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return info
+
+    @staticmethod
+    def compute(board):
+        legal = array("H", (encode_move(move) for move in board.generate_legal_moves()))
+        # same order python-chess uses in Board.outcome()
+        if not legal and board.is_check():
+            termination = chess.Termination.CHECKMATE
+        elif board.is_insufficient_material():
+            termination = chess.Termination.INSUFFICIENT_MATERIAL
+        elif not legal:
+            termination = chess.Termination.STALEMATE
+        else:
+            return PositionInfo(legal, None)
+        winner = not board.turn if termination == chess.Termination.CHECKMATE else None
+        return PositionInfo(legal, chess.Outcome(termination, winner))
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def summary(self):
+        return (f"cache {len(self.entries)}/{self.max_size} entries, "
+                f"{self.hits} hits, {self.misses} misses ({self.hit_rate():.1%} hit rate), "
+                f"{self.evictions} evictions")
+
+
+class CachedBoard:
+    # a game's board plus its running Zobrist hash, answers legality and
+    # game-over questions from the shared cache while the game is young
+    def __init__(self, board, cache):
+        self.board = board
+        self.cache = cache
+        self.zobrist = position_hash(board)
+        self.info = None
+
+    def current(self):
+        if self.info is None and self.cache.wants(self.board):
+            self.info = self.cache.lookup(self.board, self.zobrist)
+        return self.info
+
+    def is_legal(self, move):
+        info = self.current()
+        if info is None:
+            return move in self.board.legal_moves
+        return info.is_legal(move)
+
+    def push(self, move):
+        if self.cache.wants(self.board):
+            self.zobrist = hash_after(self.board, self.zobrist, move)
+        self.board.push(move)
+        self.info = None
+
+    def outcome(self):
+        # Board.outcome() of the current position
+        info = self.current()
+        if info is None:
+            return self.board.outcome()
+        if info.outcome is not None:
+            return info.outcome
+        board = self.board
+        if board.is_seventyfive_moves():
+            return chess.Outcome(chess.Termination.SEVENTYFIVE_MOVES, None)
+        if board.is_fivefold_repetition():
+            return chess.Outcome(chess.Termination.FIVEFOLD_REPETITION, None)
+        return None
@@ -0,0 +1,213 @@
+import struct
+
+import chess
+
+# wire format shared by server.py and client.py
+#
+# every message is a frame: a 4 byte header followed by the payload
+#   length  u16  payload size in bytes (header not included)
+#   version u8   PROTOCOL_VERSION
+#   type    u8   one of the message types below
+# all integers are big endian
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct("!HBB")
+MAX_PAYLOAD = 0xFFFF
+
+# message types
+HELLO = 1      # client -> server: mode u8, game id u32, argument u8
+COLOR = 2      # server -> client: color u8 (1 white, 0 black, 2 spectator), game id u32
+MOVE = 3       # both ways: encoded move u16
+ACK = 4        # server -> mover: encoded move u16 that was accepted
+REJECT = 5     # server -> mover: reason u8
+GAME_OVER = 6  # server -> client: winner u8, termination u8
+SYNC = 7       # server -> client: full board as a utf-8 FEN
+
+# HELLO modes
+MODE_PLAY = 0
+MODE_RESUME = 1  # game id, argument: color (1 white, 0 black) to take back
+MODE_SPECTATE = 2  # game id
+MODE_COMPUTER = 3  # argument: strength level (1 weakest), plus PLAY_BLACK to take black
+PLAY_BLACK = 0x80
+
+# COLOR sent to spectators
+SPECTATOR = 2
+
+# REJECT reasons
+ILLEGAL_MOVE = 1
+WRONG_FORMAT = 2
+NOT_YOUR_TURN = 3
+UNKNOWN_GAME = 4
+UNAVAILABLE = 5  # the server could not start the game
+
+# GAME_OVER winner
+WINNER_BLACK = 0
+WINNER_WHITE = 1
+DRAW = 2
+
+# GAME_OVER termination, chess.Termination values plus our own
+ABANDONED = 0
+
+_HELLO = struct.Struct("!BIB")
+_COLOR = struct.Struct("!BI")
+_MOVE = struct.Struct("!H")
+_REASON = struct.Struct("!B")
+_GAME_OVER = struct.Struct("!BB")
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+# moves are packed into 16 bits: from square (6), to square (6), promotion (3)
+def encode_move(move):
+    return move.from_square | (move.to_square << 6) | ((move.promotion or 0) << 12)
+
+
+def decode_move(value):
+    promotion = (value >> 12) & 0x7
+    if promotion and not chess.KNIGHT <= promotion <= chess.QUEEN:
+        raise ProtocolError(f"bad promotion piece {promotion}")
+    return chess.Move(value & 0x3F, (value >> 6) & 0x3F, promotion or None)
+
+
+def frame(msg_type, payload=b""):
+    if len(payload) > MAX_PAYLOAD:
+        raise ProtocolError("payload too large")
+    return HEADER.pack(len(payload), PROTOCOL_VERSION, msg_type) + payload
+
+
+def batch(*frames):
+    # several frames in one buffer so they go out in a single write
+    return b"".join(frames)
+
+
+def hello(mode=MODE_PLAY, game_id=0, arg=0):
+    return frame(HELLO, _HELLO.pack(mode, game_id, arg))
+
+
+def color(player_color, game_id):
+    return frame(COLOR, _COLOR.pack(int(player_color), game_id))
+
+
+def move(m):
+    return frame(MOVE, _MOVE.pack(encode_move(m)))
+
+
+def ack(m):
+    return frame(ACK, _MOVE.pack(encode_move(m)))
+
+
+def reject(reason):
+    return frame(REJECT, _REASON.pack(reason))
+
+
+def game_over(winner, termination):
+    return frame(GAME_OVER, _GAME_OVER.pack(winner, termination))
+
+
+def sync(fen):
+    return frame(SYNC, fen.encode())
+
+
+def winner_code(outcome):
+    if outcome is None or outcome.winner is None:
+        return DRAW
+    return WINNER_WHITE if outcome.winner == chess.WHITE else WINNER_BLACK
+
+
+def decode(msg_type, payload):
+    # payload -> tuple of fields for the given message type
+    try:
+        if msg_type == HELLO:
+            return _HELLO.unpack(payload)
+        if msg_type == COLOR:
+            player_color, game_id = _COLOR.unpack(payload)
+            if player_color == SPECTATOR:
+                return SPECTATOR, game_id
+            return bool(player_color), game_id
+        if msg_type in (MOVE, ACK):
+            return (decode_move(_MOVE.unpack(payload)[0]),)
+        if msg_type == REJECT:
+            return _REASON.unpack(payload)
+        if msg_type == GAME_OVER:
+            return _GAME_OVER.unpack(payload)
+        if msg_type == SYNC:
+            return (payload.decode(),)
+    except (struct.error, UnicodeDecodeError) as e:
+        raise ProtocolError(f"bad payload for message {msg_type}: {e}") from None
+    raise ProtocolError(f"unknown message type {msg_type}")
+
+
+def parse_header(data):
+    length, version, msg_type = HEADER.unpack(data)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"unsupported protocol version {version}")
+    return length, msg_type
+
+
+class FrameReader:
+    # reassembles frames from whatever chunks recv() hands us
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        while len(self.buffer) >= HEADER.size:
+            length, msg_type = parse_header(self.buffer[:HEADER.size])
+            end = HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            frames.append((msg_type, bytes(self.buffer[HEADER.size:end])))
+            del self.buffer[:end]
+        return frames
+
+
+class BlockingConnection:
+    # frame reader/writer on top of a plain blocking socket
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = FrameReader()
+        self.pending = []
+
+    def send(self, *frames):
+        self.sock.sendall(batch(*frames))
+
+    def recv(self):
+        # returns (type, fields) of the next message, None once the server hangs up
+        while not self.pending:
+            data = self.sock.recv(4096)
+            if not data:
+                return None
+            self.pending.extend(self.reader.feed(data))
+        msg_type, payload = self.pending.pop(0)
+        return msg_type, decode(msg_type, payload)
+
+
+async def read_raw_frame(reader):
+    # (type, undecoded payload); a ProtocolError from here means the header
+    # was bad and the stream can't be trusted any more
+    length, msg_type = parse_header(await reader.readexactly(HEADER.size))
+    return msg_type, await reader.readexactly(length)
+
+
+async def read_frame(reader):
+    # asyncio stream version, raises asyncio.IncompleteReadError on EOF
+    msg_type, payload = await read_raw_frame(reader)
+    return msg_type, decode(msg_type, payload)
+
+
+async def sock_read_frame(loop, sock):
+    # read exactly one frame from a non-blocking socket, nothing past it
+    async def read_exactly(n):
+        data = b""
+        while len(data) < n:
+            chunk = await loop.sock_recv(sock, n - len(data))
+            if not chunk:
+                raise ConnectionError("connection closed")
+            data += chunk
+        return data
+
+    length, msg_type = parse_header(await read_exactly(HEADER.size))
+    payload = await read_exactly(length)
+    return msg_type, decode(msg_type, payload)
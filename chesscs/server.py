@@ -1,114 +1,305 @@
+import argparse
+import asyncio
+import itertools
+import multiprocessing
+import os
+import signal
 import socket
-import chess
-
-board = chess.Board()
-
-# socket objects
-s1 = socket.socket()
-s2 = socket.socket()
-print("Socket created")
-
-
-# white = 12345, black = 12346
-player1_port = 12345
-player2_port = 12346
-
-# assigning ports to sockets and players
-s1.bind(('', player1_port))
-print("socket binded to %s" %(player1_port))
-s2.bind(('', player2_port))
-print("socket binded to %s" %(player2_port))
-
-# socket set to listen
-s1.listen(1)
-print("socket 1 is listening")
-s2.listen(1)
-print("socket 2 is listening")
-
-# blocking call, sits and waits until players connect
-c1, addr1 = s1.accept()
-print("Player 1 has connected from ", addr1)
-c1.send("Your are playing as WHITE".encode())
-
-c2, addr2 = s2.accept()
-print("Player 2 has connected from ", addr2)
-c2.send("You are playing as BLACK".encode())
-
-# turn order tracking
-white_turn = True
-
-fen = board.fen() # Get the FEN representation of the board
-send_str = f"Board:\n{fen}"
-c1.send(send_str.encode())
-c2.send(send_str.encode())
-
-# game running until it ends
-while True:
-    print("Turn: ", board.turn)
-    # sending board to white
-    if board.turn:
-
-        # Receive move 
-        print("Waiting for White to play")
-        data = c1.recv(1024)
-        print("Data received : ", data.decode())
-        try:
-            # trying to make a move out of sent input
-            # chess class from the library handles all this
-            move = chess.Move.from_uci(data.decode())
-            if move in board.legal_moves:
-                board.push(move)
-                if board.is_game_over():
-                    win = "\nYou Win!\nBoard:\n" + str(board)
-                    lose = "\nYou Lose!\nBoard:\n" + str(board)
-                    c1.send(win.encode())
-                    c2.send(lose.encode())
-                    c1.close()
-                    c2.close()
-                    break
-                else:
-                    c1.send("Move is legal".encode())
-                    fen = board.fen() # Get the FEN representation of the board
-                    send_str = f"Board:\n{fen}"
-                    c1.send(send_str.encode())
-                    c2.send(send_str.encode())
+import time
+
+import protocol
+from engine import default_processes
+from movecache import DEFAULT_CACHE_PLIES, DEFAULT_CACHE_SIZE
+from worker import CONTROL_MSG, COMPUTER, FINISHED, LIVE, NEW_GAME, READY, RESUME, SPECTATE, GameWorker, worker_main
+
+# every player connects to this one port, the lobby pairs them into games
+DEFAULT_PORT = 12345
+# seconds a new connection gets to send its HELLO
+HELLO_TIMEOUT = 10
+# a worker that dies sooner than this after starting is not started again
+RESPAWN_MIN_UPTIME = 5
+
+
+class WorkerHandle:
+    # the router's view of one worker process
+    def __init__(self, index, process, control):
+        self.index = index
+        self.process = process
+        self.control = control
+        self.games = set()
+        self.started = time.monotonic()
+        self.ready = False
+
+    def send(self, kind, game_id, socks, arg=0):
+        # hand the player sockets over, the worker owns them from now on
+        socket.send_fds(self.control, [CONTROL_MSG.pack(kind, game_id, arg)], [s.fileno() for s in socks])
+
+
+class LocalWorker:
+    # runs games inside the router process (--workers 0)
+    def __init__(self, on_report, options):
+        self.index = 0
+        self.games = set()
+        self.ready = False
+        self.worker = GameWorker("local", 0, lambda kind, game_id: on_report(self, kind, game_id), options)
+
+    def send(self, kind, game_id, socks, arg=0):
+        # the local worker keeps using these sockets, so pass duplicates
+        # because the router closes its copies after a hand-off
+        dups = [sock.dup() for sock in socks]
+        if kind == NEW_GAME:
+            asyncio.create_task(self.worker.start_game(game_id, *dups))
+        elif kind == RESUME:
+            asyncio.create_task(self.worker.resume_player(game_id, bool(arg), *dups))
+        elif kind == SPECTATE:
+            asyncio.create_task(self.worker.add_spectator(game_id, *dups))
+        elif kind == COMPUTER:
+            asyncio.create_task(self.worker.start_computer_game(game_id, *dups, arg))
+
+
+class Router:
+    # accepts players, pairs them and spreads the games across workers
+    def __init__(self, options):
+        self.options = options
+        self.workers = []
+        self.waiting = asyncio.Queue()
+        self.game_ids = None
+        self.owner = {}
+        # workers still recovering their journal
+        self.recovering = 0
+        self.max_game_id = 0
+        self.ready = asyncio.Event()
+
+    def start_workers(self):
+        if self.options.workers == 0:
+            local = LocalWorker(self.on_message, self.options)
+            self.workers.append(local)
+            self.recovering = 1
+            local.worker.recover()
+            return
+        for index in range(self.options.workers):
+            self.spawn_worker(index)
+        self.recovering = len(self.workers)
+
+    def spawn_worker(self, index, games=None):
+        # games: ids a replacement worker takes back from the journal
+        loop = asyncio.get_running_loop()
+        parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        process = multiprocessing.get_context("spawn").Process(
+            target=worker_main, name=f"chess-worker-{index}", args=(index, child, self.options, games))
+        process.start()
+        child.close()
+        handle = WorkerHandle(index, process, parent)
+        loop.add_reader(parent, self.on_report, handle)
+        self.workers.append(handle)
+
+    def stop_workers(self):
+        for handle in self.workers:
+            if isinstance(handle, WorkerHandle):
+                handle.control.close()
+                handle.process.join(timeout=2)
+                if handle.process.is_alive():
+                    handle.process.terminate()
             else:
-                c1.send("Illegal Move, try again".encode())
-                continue
-        except ValueError:
-            c1.send("Wrong Format".encode())
-            continue
-    # same but for black
-    else:
-        
-        # Receive Move
-        print("Waiting for Black to play")
-        data = c2.recv(1024)
-        print("Data received : ", data.decode())
+                handle.worker.close()
+
+    def on_report(self, handle):
+        msg = handle.control.recv(CONTROL_MSG.size)
+        if not msg:
+            asyncio.get_running_loop().remove_reader(handle.control)
+            self.worker_exited(handle)
+            return
+        kind, game_id, _ = CONTROL_MSG.unpack(msg)
+        self.on_message(handle, kind, game_id)
+
+    def worker_exited(self, handle):
+        # its games went down with it, they can come back from the journal
+        handle.control.close()
+        handle.process.join(timeout=1)
+        self.workers.remove(handle)
+        for game_id in handle.games:
+            if self.owner.get(game_id) is handle:
+                del self.owner[game_id]
+        exitcode = handle.process.exitcode
+        if exitcode == 0:
+            # a clean exit, the server is shutting down
+            print(f"worker {handle.index} exited")
+            return
+        if time.monotonic() - handle.started < RESPAWN_MIN_UPTIME:
+            print(f"worker {handle.index} died right after starting (exit code {exitcode}), not restarting it")
+            if not handle.ready:
+                # don't let startup wait for it
+                self.on_message(handle, READY, 0)
+            return
+        print(f"worker {handle.index} died (exit code {exitcode}), restarting it with {len(handle.games)} games")
+        self.spawn_worker(handle.index, sorted(handle.games))
 
+    def on_message(self, handle, kind, game_id):
+        if kind == FINISHED:
+            self.game_finished(game_id)
+        elif kind == LIVE:
+            # recovered game, its players will come back with MODE_RESUME
+            self.owner[game_id] = handle
+            handle.games.add(game_id)
+        elif kind == READY:
+            handle.ready = True
+            if self.ready.is_set():
+                # a replacement worker, ids are already being handed out
+                return
+            self.max_game_id = max(self.max_game_id, game_id)
+            self.recovering -= 1
+            if self.recovering == 0:
+                # never hand out an id the journal has already seen
+                self.game_ids = itertools.count(self.max_game_id + 1)
+                self.ready.set()
+
+    def game_finished(self, game_id):
+        handle = self.owner.pop(game_id, None)
+        if handle is not None:
+            handle.games.discard(game_id)
+
+    def pick_worker(self):
+        # balance by number of active games
+        return min(self.workers, key=lambda handle: len(handle.games))
+
+    async def accept_loop(self, listener):
+        loop = asyncio.get_running_loop()
+        while True:
+            sock, addr = await loop.sock_accept(listener)
+            sock.setblocking(False)
+            print("Player connected from ", addr)
+            asyncio.create_task(self.greet(sock))
+
+    async def greet(self, sock):
+        # the first frame says what the client wants, anything else is dropped
+        loop = asyncio.get_running_loop()
         try:
-            move = chess.Move.from_uci(data.decode())
-            if move in board.legal_moves:
-                board.push(move)
-                if board.is_game_over():
-                    win = "\nYou Win!\nBoard:\n" + str(board)
-                    lose = "\nYou Lose!\nBoard:\n" + str(board)
-                    c2.send(win.encode())
-                    c1.send(lose.encode())
-                    c1.close()
-                    c2.close()
-                    break
-                else:
-                    c2.send("Move is legal".encode())
-                    fen = board.fen() # Get the FEN representation of the board
-                    send_str = f"Board:\n{fen}"
-                    c1.send(send_str.encode())
-                    c2.send(send_str.encode())
+            msg_type, fields = await asyncio.wait_for(protocol.sock_read_frame(loop, sock), HELLO_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError, protocol.ProtocolError) as e:
+            print("Dropping client: ", e or "no hello")
+            sock.close()
+            return
+        if msg_type != protocol.HELLO:
+            sock.close()
+            return
+        mode, game_id, arg = fields
+        if mode == protocol.MODE_PLAY:
+            await self.waiting.put(sock)
+        elif mode == protocol.MODE_RESUME:
+            # a player coming back to a game that survived a restart
+            await self.forward(sock, RESUME, game_id, arg)
+        elif mode == protocol.MODE_SPECTATE:
+            await self.forward(sock, SPECTATE, game_id)
+        elif mode == protocol.MODE_COMPUTER:
+            # no opponent to wait for, the game starts right away
+            self.start_game(COMPUTER, [sock], arg)
+        else:
+            sock.close()
+
+    async def forward(self, sock, kind, game_id, arg=0):
+        # pass a connection to the worker that runs game_id
+        handle = self.owner.get(game_id)
+        try:
+            if handle is None:
+                await asyncio.get_running_loop().sock_sendall(sock, protocol.reject(protocol.UNKNOWN_GAME))
             else:
-                c2.send("Illegal Move, try again".encode())
+                handle.send(kind, game_id, [sock], arg)
+        except OSError as e:
+            print(f"could not pass connection to game {game_id}: {e}")
+        finally:
+            sock.close()
+
+    async def next_player(self):
+        # skip anyone who gave up while sitting in the queue
+        while True:
+            sock = await self.waiting.get()
+            if still_connected(sock):
+                return sock
+            sock.close()
+
+    async def matchmaker(self):
+        while True:
+            # first in the queue plays white, second plays black
+            white = await self.next_player()
+            black = await self.next_player()
+            if not still_connected(white):
+                # white left while we waited for black, black keeps waiting
+                white.close()
+                await self.waiting.put(black)
                 continue
-        except ValueError:
-            c2.send("Wrong Format".encode())
-            continue
-    
-    # stopping when connection ends
+            self.start_game(NEW_GAME, [white, black])
+
+    def start_game(self, kind, socks, arg=0):
+        game_id = next(self.game_ids)
+        try:
+            if not self.workers:
+                raise OSError("no game workers left")
+            handle = self.pick_worker()
+            handle.send(kind, game_id, socks, arg)
+            handle.games.add(game_id)
+            self.owner[game_id] = handle
+        except OSError as e:
+            print(f"could not start game {game_id}: {e}")
+            # tell the players instead of just hanging up on them
+            for sock in socks:
+                try:
+                    sock.send(protocol.reject(protocol.UNAVAILABLE))
+                except OSError:
+                    pass
+        finally:
+            for sock in socks:
+                sock.close()
+        print("Active games: ", [len(h.games) for h in self.workers])
+
+
+def still_connected(sock):
+    # peek without consuming: b"" means the client hung up
+    try:
+        return sock.recv(1, socket.MSG_PEEK) != b""
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+
+
+async def main(options):
+    router = Router(options)
+    # start the workers before opening the port so they never inherit it
+    router.start_workers()
+    await router.ready.wait()
+    listener = socket.create_server((options.host, options.port), backlog=1024)
+    listener.setblocking(False)
+    print("socket binded to %s" %(options.port))
+    # SIGTERM shuts down like Ctrl-C, so workers get to seal their journal
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    try:
+        await asyncio.gather(router.accept_loop(listener), router.matchmaker())
+    finally:
+        listener.close()
+        router.stop_workers()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chess game server")
+    parser.add_argument("--host", default="")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    # handing sockets to other processes needs SCM_RIGHTS (Unix only)
+    default_workers = (os.cpu_count() or 1) if hasattr(socket, "send_fds") else 0
+    parser.add_argument("--workers", type=int, default=default_workers,
+                        help="game worker processes, 0 runs every game in the router process")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE,
+                        help="positions in each worker's legal move cache, 0 disables it")
+    parser.add_argument("--cache-plies", type=int, default=DEFAULT_CACHE_PLIES,
+                        help="only cache positions up to this ply")
+    parser.add_argument("--journal", default="journal",
+                        help="directory for the game journal, empty to run without one")
+    parser.add_argument("--engine-procs", type=int,
+                        help="engine processes per worker for games against the computer, started with "
+                             "the first such game (default: cores // workers, at least 1)")
+    args = parser.parse_args()
+    if args.engine_procs is None:
+        args.engine_procs = default_processes(args.workers)
+    try:
+        asyncio.run(main(args))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
@@ -0,0 +1,235 @@
+import asyncio
+import os
+import socket
+import struct
+
+import chess
+
+import protocol
+from engine import DEFAULT_LEVEL, LEVELS, EnginePool, play_computer
+from game import GameSession, play_game
+from journal import Journal
+from movecache import MoveCache
+
+# control channel between the router and a worker, one message per packet
+#   kind u8, game id u32, argument u8
+# router -> worker, the player sockets ride along as SCM_RIGHTS fds
+#   NEW_GAME  two fds (white, black)
+#   RESUME    one fd, argument is the color the player takes back
+#   SPECTATE  one fd, the connection watches the game
+#   COMPUTER  one fd, a new game against the engine, argument as in the HELLO
+# worker -> router
+#   FINISHED  the game is over
+#   LIVE      a game recovered from the journal waits for its players
+#   READY     recovery done, game id is the highest one in the journal
+CONTROL_MSG = struct.Struct("!BIB")
+NEW_GAME = 1
+RESUME = 2
+FINISHED = 3
+LIVE = 4
+READY = 5
+SPECTATE = 6
+COMPUTER = 7
+
+# seconds a recovered game waits for both players to come back
+RESUME_TIMEOUT = 300
+
+
+class GameWorker:
+    # runs any number of games on the current event loop
+    def __init__(self, name, index, on_report, options):
+        self.name = name
+        self.index = index
+        self.on_report = on_report
+        self.games = {}
+        self.sessions = {}
+        # recovered games waiting for players: game id -> (board, {color: streams}, computer)
+        self.suspended = {}
+        # one cache for all games of this worker
+        self.cache = MoveCache(options.cache_size, options.cache_plies)
+        self.journal = None
+        if options.journal:
+            self.journal = Journal(os.path.join(options.journal, f"worker-{index}"))
+            self.journal_root = options.journal
+        self.num_workers = max(1, options.workers)
+        # searches for every computer game of this worker
+        self.engine = EnginePool(options.engine_procs)
+        self.computers = set()
+
+    def recover(self, game_ids=None):
+        # rebuild the boards of unfinished games, then tell the router about them.
+        # game_ids: the games of a crashed worker this one replaces, by default
+        # every worker looks at the whole journal and rebuilds its share
+        max_game_id = 0
+        if self.journal is not None:
+            if game_ids is None:
+                share = lambda game_id: game_id % self.num_workers == self.index
+            else:
+                share = set(game_ids).__contains__
+            games, max_game_id = self.journal.open(self.journal_root, share)
+            for game_id, game in games.items():
+                self.suspended[game_id] = (game.board, {}, game.computer)
+                if game.computer:
+                    # the engine takes its seat again, only the human has to come back
+                    asyncio.create_task(self.resume_computer(game_id, game.computer))
+                asyncio.get_running_loop().call_later(RESUME_TIMEOUT, self.abandon, game_id)
+                print(f"[{self.name}] recovered game {game_id} at ply {game.board.ply()}")
+                self.on_report(LIVE, game_id)
+        self.on_report(READY, max_game_id)
+
+    async def start_game(self, game_id, white_sock, black_sock):
+        white = await asyncio.open_connection(sock=white_sock)
+        black = await asyncio.open_connection(sock=black_sock)
+        session = GameSession(game_id, white, black, self.cache, self.journal)
+        self.run(session)
+
+    async def resume_player(self, game_id, color, sock):
+        streams = await asyncio.open_connection(sock=sock)
+        if game_id not in self.suspended:
+            streams[1].write(protocol.reject(protocol.UNKNOWN_GAME))
+            streams[1].close()
+            return
+        self.take_seat(game_id, color, streams)
+
+    async def resume_computer(self, game_id, computer):
+        streams = await self.connect_computer(computer & ~protocol.PLAY_BLACK, resumed=True)
+        if game_id not in self.suspended:
+            streams[1].close()
+            return
+        self.take_seat(game_id, bool(computer & protocol.PLAY_BLACK), streams)
+
+    def take_seat(self, game_id, color, streams):
+        board, players, computer = self.suspended[game_id]
+        if color in players:
+            # reconnected twice, the newer connection wins
+            players[color][1].close()
+        players[color] = streams
+        if len(players) == 2:
+            del self.suspended[game_id]
+            session = GameSession(game_id, players[chess.WHITE], players[chess.BLACK],
+                                  self.cache, self.journal, board, computer)
+            self.run(session, resumed=True)
+
+    async def connect_computer(self, level, resumed=False):
+        # the engine plays through a socket pair like any other client, so the
+        # game itself (journal, spectators) does not know the difference
+        await self.engine.start()
+        game_end, engine_end = socket.socketpair()
+        computer = await asyncio.open_connection(sock=game_end)
+        engine_streams = await asyncio.open_connection(sock=engine_end)
+        task = asyncio.create_task(play_computer(self.engine, level, *engine_streams, resumed))
+        self.computers.add(task)
+        task.add_done_callback(self.computers.discard)
+        return computer
+
+    async def start_computer_game(self, game_id, sock, arg):
+        human = await asyncio.open_connection(sock=sock)
+        level = arg & ~protocol.PLAY_BLACK
+        if level not in LEVELS:
+            level = DEFAULT_LEVEL
+        computer = await self.connect_computer(level)
+        # journaled with the game, so it can be rebuilt with the engine in its seat
+        arg = level | (arg & protocol.PLAY_BLACK)
+        if arg & protocol.PLAY_BLACK:
+            session = GameSession(game_id, computer, human, self.cache, self.journal, computer=arg)
+        else:
+            session = GameSession(game_id, human, computer, self.cache, self.journal, computer=arg)
+        print(f"[{self.name}] game {game_id} against the computer, level {level}")
+        self.run(session)
+
+    async def add_spectator(self, game_id, sock):
+        reader, writer = await asyncio.open_connection(sock=sock)
+        session = self.sessions.get(game_id)
+        if session is None:
+            writer.write(protocol.reject(protocol.UNKNOWN_GAME))
+            writer.close()
+            return
+        session.watch(reader, writer)
+
+    def abandon(self, game_id):
+        if game_id not in self.suspended:
+            return
+        board, players, _ = self.suspended.pop(game_id)
+        print(f"[{self.name}] recovered game {game_id} abandoned")
+        for _, writer in players.values():
+            writer.write(protocol.game_over(protocol.DRAW, protocol.ABANDONED))
+            writer.close()
+        task = asyncio.create_task(self.journal.end_game(game_id, board.ply(), protocol.DRAW, protocol.ABANDONED))
+        task.add_done_callback(lambda _: self.on_report(FINISHED, game_id))
+
+    def run(self, session, resumed=False):
+        task = asyncio.create_task(play_game(session, resumed))
+        self.games[session.game_id] = task
+        self.sessions[session.game_id] = session
+        task.add_done_callback(lambda _: self.finish(session.game_id))
+
+    def finish(self, game_id):
+        self.games.pop(game_id, None)
+        self.sessions.pop(game_id, None)
+        summary = self.cache.summary()
+        if self.journal is not None:
+            summary += ", " + self.journal.summary()
+        if self.engine.searches:
+            summary += ", " + self.engine.summary()
+        print(f"[{self.name}] game {game_id} done, {len(self.games)} active, {summary}")
+        self.on_report(FINISHED, game_id)
+
+    def close(self):
+        self.engine.close()
+        if self.journal is not None:
+            self.journal.close()
+
+
+async def serve_worker(index, control, options, game_ids=None):
+    loop = asyncio.get_running_loop()
+    stopped = loop.create_future()
+
+    def report(kind, game_id):
+        try:
+            control.send(CONTROL_MSG.pack(kind, game_id, 0))
+        except OSError:
+            pass
+
+    worker = GameWorker(f"worker {index}", index, report, options)
+
+    def on_control():
+        try:
+            msg, fds, _, _ = socket.recv_fds(control, CONTROL_MSG.size, 2)
+        except OSError:
+            msg, fds = b"", []
+        if not msg:
+            # router went away
+            loop.remove_reader(control)
+            if not stopped.done():
+                stopped.set_result(None)
+            return
+        kind, game_id, arg = CONTROL_MSG.unpack(msg)
+        socks = [socket.socket(fileno=fd) for fd in fds]
+        for sock in socks:
+            sock.setblocking(False)
+        if kind == NEW_GAME and len(socks) == 2:
+            loop.create_task(worker.start_game(game_id, *socks))
+        elif kind == RESUME and len(socks) == 1:
+            loop.create_task(worker.resume_player(game_id, bool(arg), socks[0]))
+        elif kind == SPECTATE and len(socks) == 1:
+            loop.create_task(worker.add_spectator(game_id, socks[0]))
+        elif kind == COMPUTER and len(socks) == 1:
+            loop.create_task(worker.start_computer_game(game_id, socks[0], arg))
+        else:
+            for sock in socks:
+                sock.close()
+
+    worker.recover(game_ids)
+    loop.add_reader(control, on_control)
+    try:
+        await stopped
+    finally:
+        worker.close()
+
+
+def worker_main(index, control, options, game_ids=None):
+    # entry point of a worker process
+    try:
+        asyncio.run(serve_worker(index, control, options, game_ids))
+    except KeyboardInterrupt:
+        pass
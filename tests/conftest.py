@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules in chesscs/ import each other by bare name, like the scripts do
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "chesscs"))
@@ -0,0 +1,51 @@
+import asyncio
+import socket
+import struct
+
+import chess
+
+import protocol
+from game import GameSession, play_game
+
+
+async def connect():
+    server, client = socket.socketpair()
+    return await asyncio.open_connection(sock=server), await asyncio.open_connection(sock=client)
+
+
+async def start_game():
+    (white, white_client), (black, black_client) = await connect(), await connect()
+    task = asyncio.create_task(play_game(GameSession(1, white, black)))
+    assert await protocol.read_frame(white_client[0]) == (protocol.COLOR, (True, 1))
+    assert await protocol.read_frame(black_client[0]) == (protocol.COLOR, (False, 1))
+    return task, white_client, black_client
+
+
+def test_bad_payload_is_rejected_and_the_game_goes_on():
+    async def run():
+        task, (white_reader, white_writer), (black_reader, black_writer) = await start_game()
+        e2e4 = chess.Move.from_uci("e2e4")
+        white_writer.write(protocol.frame(protocol.MOVE, struct.pack("!H", protocol.encode_move(e2e4) | 7 << 12)))
+        white_writer.write(protocol.frame(protocol.MOVE, b"\x01\x02\x03"))
+        white_writer.write(protocol.move(e2e4))
+        reject = (protocol.REJECT, (protocol.WRONG_FORMAT,))
+        assert await protocol.read_frame(white_reader) == reject
+        assert await protocol.read_frame(white_reader) == reject
+        assert await protocol.read_frame(white_reader) == (protocol.ACK, (e2e4,))
+        assert await protocol.read_frame(black_reader) == (protocol.MOVE, (e2e4,))
+        black_writer.close()
+        assert await protocol.read_frame(white_reader) == (
+            protocol.GAME_OVER, (protocol.WINNER_WHITE, protocol.ABANDONED))
+        await task
+
+    asyncio.run(run())
+
+
+def test_bad_header_ends_the_connection():
+    async def run():
+        task, (white_reader, white_writer), _ = await start_game()
+        white_writer.write(protocol.HEADER.pack(2, protocol.PROTOCOL_VERSION + 1, protocol.MOVE) + b"\0\0")
+        assert await protocol.read_frame(white_reader) == (protocol.REJECT, (protocol.WRONG_FORMAT,))
+        await task
+
+    asyncio.run(run())
@@ -0,0 +1,144 @@
+import asyncio
+import os
+
+import chess
+import pytest
+
+import journal
+import protocol
+from journal import END, MOVE, START, JournalWriter, recover
+
+MOVES = ["e2e4", "e7e5", "g1f3", "b8c6", "f1b5", "a7a6"]
+
+
+def move_records(game_id, moves, first_ply=0):
+    return [(MOVE, game_id, first_ply + i, protocol.encode_move(chess.Move.from_uci(uci)), 0.0)
+            for i, uci in enumerate(moves)]
+
+
+def write_segment(directory, records, number=1, seal=False):
+    os.makedirs(directory, exist_ok=True)
+    writer = JournalWriter(str(directory), journal.DEFAULT_SEGMENT_SIZE)
+    writer.open_segment(number)
+    writer.write_batch(records)
+    if seal:
+        writer.close()
+    else:
+        # a crash: the segment stays without an index
+        writer.file.close()
+    return journal.segment_path(str(directory), number)
+
+
+def board_after(moves):
+    board = chess.Board()
+    for uci in moves:
+        board.push_uci(uci)
+    return board
+
+
+def test_recover_live_and_ended_games(tmp_path):
+    write_segment(tmp_path, [(START, 1, 0, 0, 0.0), (START, 2, 0, 0, 0.0)]
+                  + move_records(1, MOVES) + move_records(2, MOVES[:2])
+                  + [(END, 2, 2, protocol.DRAW << 8 | protocol.ABANDONED, 0.0)])
+    games, max_id = recover(str(tmp_path))
+    assert max_id == 2
+    assert list(games) == [1]
+    assert games[1].board == board_after(MOVES)
+    assert games[1].computer == 0
+
+
+def test_recover_torn_last_record(tmp_path):
+    path = write_segment(tmp_path, [(START, 7, 0, 0, 0.0)] + move_records(7, MOVES))
+    size = os.path.getsize(path)
+    # the last record only half made it to disk
+    with open(path, "r+b") as f:
+        f.truncate(size - journal.RECORD.size // 2)
+    games, max_id = recover(str(tmp_path))
+    assert max_id == 7
+    assert games[7].board == board_after(MOVES[:-1])
+
+
+def test_recover_corrupt_last_record(tmp_path):
+    path = write_segment(tmp_path, [(START, 7, 0, 0, 0.0)] + move_records(7, MOVES))
+    with open(path, "r+b") as f:
+        f.seek(-1, os.SEEK_END)
+        f.write(b"\xff")
+    games, _ = recover(str(tmp_path))
+    assert games[7].board == board_after(MOVES[:-1])
+
+
+def test_recover_rebuilds_old_format_index(tmp_path):
+    write_segment(tmp_path, [(START, 3, 0, 0, 0.0)] + move_records(3, MOVES), seal=True)
+    idx = journal.segment_path(str(tmp_path), 1, "idx")
+    # an index from before INDEX_MAGIC: bare entry rows
+    with open(idx, "wb") as f:
+        f.write(journal.INDEX_ENTRY.pack(3, 0, 7, journal.FLAG_STARTED))
+    games, max_id = recover(str(tmp_path))
+    assert max_id == 3
+    assert games[3].board == board_after(MOVES)
+    # the owner of the directory writes a current index in its place
+    recover(str(tmp_path), own_dir=str(tmp_path))
+    with open(idx, "rb") as f:
+        assert f.read(len(journal.INDEX_MAGIC)) == journal.INDEX_MAGIC
+    assert journal.read_game(str(tmp_path), 3)[-1][:2] == (MOVE, len(MOVES) - 1)
+
+
+def test_recover_game_split_across_workers(tmp_path):
+    # started by worker 0, which died; worker 1 took the game over
+    write_segment(tmp_path / "worker-0", [(START, 5, 0, 0, 0.0), (START, 6, 0, 0, 0.0)]
+                  + move_records(5, MOVES[:3]), seal=True)
+    write_segment(tmp_path / "worker-1", move_records(5, MOVES[3:], first_ply=3)
+                  + [(END, 6, 0, protocol.DRAW << 8 | protocol.ABANDONED, 0.0)])
+    games, max_id = recover(str(tmp_path))
+    assert max_id == 6
+    assert list(games) == [5]
+    assert games[5].board == board_after(MOVES)
+    assert len(journal.read_game(str(tmp_path), 5)) == 1 + len(MOVES)
+    games, max_id = recover(str(tmp_path), share=lambda game_id: game_id % 2 == 0)
+    assert games == {} and max_id == 6
+
+
+def test_recover_computer_game(tmp_path):
+    arg = 3 | protocol.PLAY_BLACK
+    write_segment(tmp_path, [(START, 9, 0, arg, 0.0)] + move_records(9, MOVES[:1]))
+    games, _ = recover(str(tmp_path))
+    assert games[9].computer == arg
+
+
+def test_failed_write_is_rewound(tmp_path, monkeypatch):
+    writer = JournalWriter(str(tmp_path), journal.DEFAULT_SEGMENT_SIZE)
+    writer.open_segment(1)
+    writer.write_batch([(START, 1, 0, 0, 0.0)])
+    fsync = os.fsync
+    calls = []
+
+    def failing_fsync(fd):
+        calls.append(fd)
+        if len(calls) == 1:
+            raise OSError("disk full")
+        fsync(fd)
+
+    monkeypatch.setattr(os, "fsync", failing_fsync)
+    with pytest.raises(OSError):
+        writer.write_batch(move_records(1, MOVES[:2]))
+    monkeypatch.setattr(os, "fsync", fsync)
+    writer.write_batch(move_records(1, MOVES[:1]))
+    writer.close()
+    records = journal.read_game(str(tmp_path), 1)
+    assert [kind for kind, *_ in records] == [START, MOVE]
+    assert os.path.getsize(journal.segment_path(str(tmp_path), 1)) == len(journal.MAGIC) + 2 * journal.RECORD.size
+
+
+def test_journal_groups_appends(tmp_path):
+    async def run():
+        log = journal.Journal(str(tmp_path / "worker-0"))
+        assert log.open(str(tmp_path)) == ({}, 0)
+        await log.start_game(1)
+        await asyncio.gather(*(log.move(1, ply, chess.Move.from_uci(uci)) for ply, uci in enumerate(MOVES)))
+        assert log.records == 1 + len(MOVES)
+        assert log.batches < log.records
+        log.close()
+
+    asyncio.run(run())
+    games, _ = recover(str(tmp_path))
+    assert games[1].board == board_after(MOVES)
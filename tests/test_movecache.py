@@ -0,0 +1,76 @@
+import random
+
+import chess
+import pytest
+
+from movecache import CachedBoard, MoveCache, hash_after, position_hash
+
+
+def random_games(count, seed=7):
+    rng = random.Random(seed)
+    for _ in range(count):
+        board = chess.Board()
+        while not board.is_game_over() and board.ply() < 300:
+            yield board, rng.choice(list(board.legal_moves))
+
+
+def test_hash_after_matches_full_hash_in_random_games():
+    seen = set()
+    for board, move in random_games(60):
+        if board.is_castling(move):
+            seen.add("castling")
+        elif board.is_en_passant(move):
+            seen.add("en passant")
+        elif move.promotion:
+            seen.add("capture promotion" if board.is_capture(move) else "promotion")
+        expected = hash_after(board, position_hash(board), move)
+        board.push(move)
+        assert expected == position_hash(board), board.fen()
+    # the games must have gone through every special move at least once
+    assert seen == {"castling", "en passant", "promotion", "capture promotion"}
+
+
+@pytest.mark.parametrize("fen, uci", [
+    ("r3k2r/pppppppp/8/8/8/8/PPPPPPPP/R3K2R w KQkq - 0 1", "e1g1"),
+    ("r3k2r/pppppppp/8/8/8/8/PPPPPPPP/R3K2R w KQkq - 0 1", "e1c1"),
+    ("r3k2r/pppppppp/8/8/8/8/PPPPPPPP/R3K2R b KQkq - 0 1", "e8g8"),
+    ("r3k2r/pppppppp/8/8/8/8/PPPPPPPP/R3K2R b KQkq - 0 1", "e8c8"),
+    ("4k3/8/8/3pP3/8/8/8/4K3 w - d6 0 2", "e5d6"),
+    ("4k3/8/8/8/3pP3/8/8/4K3 b - e3 0 2", "d4e3"),
+    ("1r2k3/P7/8/8/8/8/8/4K3 w - - 0 1", "a7a8q"),
+    ("1r2k3/P7/8/8/8/8/8/4K3 w - - 0 1", "a7b8n"),
+    ("4k3/8/8/8/8/8/p7/1R2K3 b - - 0 1", "a2b1r"),
+])
+def test_hash_after_special_moves(fen, uci):
+    board = chess.Board(fen)
+    move = chess.Move.from_uci(uci)
+    expected = hash_after(board, position_hash(board), move)
+    board.push(move)
+    assert expected == position_hash(board)
+
+
+def test_cached_board_agrees_with_board():
+    cache = MoveCache(max_size=500, max_ply=300)
+    board = None
+    for plain, move in random_games(10, seed=11):
+        if plain.ply() == 0:
+            board = CachedBoard(chess.Board(), cache)
+        assert set(board.board.legal_moves) == set(plain.legal_moves)
+        assert board.is_legal(move)
+        assert board.is_legal(chess.Move.null()) is False
+        board.push(move)
+        plain.push(move)
+        assert board.outcome() == plain.outcome()
+    assert len(cache.entries) <= 500
+    assert cache.evictions > 0
+
+
+def test_cache_key_separates_castling_rights_and_en_passant():
+    with_rights = chess.Board("r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1")
+    without = chess.Board("r3k2r/8/8/8/8/8/8/R3K2R w - - 0 1")
+    assert position_hash(with_rights) == position_hash(without)
+    cache = MoveCache()
+    castle = chess.Move.from_uci("e1g1")
+    assert cache.lookup(with_rights, position_hash(with_rights)).is_legal(castle)
+    assert not cache.lookup(without, position_hash(without)).is_legal(castle)
+    assert cache.misses == 2
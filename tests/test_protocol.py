@@ -0,0 +1,100 @@
+import asyncio
+import struct
+
+import chess
+import pytest
+
+import protocol
+
+
+def test_move_round_trip():
+    for from_square in chess.SQUARES:
+        for to_square in chess.SQUARES:
+            for promotion in (None, chess.KNIGHT, chess.BISHOP, chess.ROOK, chess.QUEEN):
+                move = chess.Move(from_square, to_square, promotion)
+                value = protocol.encode_move(move)
+                assert 0 <= value <= 0xFFFF
+                assert protocol.decode_move(value) == move
+
+
+@pytest.mark.parametrize("promotion", [chess.PAWN, chess.KING, 7])
+def test_decode_move_rejects_bad_promotion(promotion):
+    with pytest.raises(protocol.ProtocolError):
+        protocol.decode_move(12 | (28 << 6) | (promotion << 12))
+
+
+def sample_frames():
+    return [
+        protocol.hello(protocol.MODE_RESUME, 42, 1),
+        protocol.color(chess.BLACK, 42),
+        protocol.move(chess.Move.from_uci("e7e8q")),
+        protocol.ack(chess.Move.from_uci("e2e4")),
+        protocol.reject(protocol.ILLEGAL_MOVE),
+        protocol.game_over(protocol.WINNER_WHITE, chess.Termination.CHECKMATE.value),
+        protocol.sync(chess.STARTING_FEN),
+    ]
+
+
+def decoded(frames):
+    return [(msg_type, protocol.decode(msg_type, payload)) for msg_type, payload in frames]
+
+
+def test_frame_reader_coalesced():
+    frames = sample_frames()
+    reader = protocol.FrameReader()
+    got = reader.feed(protocol.batch(*frames))
+    assert [msg_type for msg_type, _ in got] == [
+        protocol.HELLO, protocol.COLOR, protocol.MOVE, protocol.ACK,
+        protocol.REJECT, protocol.GAME_OVER, protocol.SYNC]
+    assert decoded(got)[1] == (protocol.COLOR, (False, 42))
+    assert decoded(got)[2] == (protocol.MOVE, (chess.Move.from_uci("e7e8q"),))
+    assert decoded(got)[6] == (protocol.SYNC, (chess.STARTING_FEN,))
+    assert reader.buffer == bytearray()
+
+
+def test_frame_reader_split():
+    data = protocol.batch(*sample_frames())
+    whole = protocol.FrameReader().feed(data)
+    reader = protocol.FrameReader()
+    got = []
+    for i in range(len(data)):
+        got += reader.feed(data[i:i + 1])
+    assert got == whole
+
+
+def test_frame_reader_keeps_partial_frame():
+    first, second = protocol.move(chess.Move.from_uci("g1f3")), protocol.sync(chess.STARTING_FEN)
+    reader = protocol.FrameReader()
+    assert len(reader.feed(first + second[:7])) == 1
+    assert reader.feed(second[7:]) == [(protocol.SYNC, chess.STARTING_FEN.encode())]
+
+
+def test_bad_version():
+    data = protocol.HEADER.pack(2, protocol.PROTOCOL_VERSION + 1, protocol.MOVE) + b"\0\0"
+    with pytest.raises(protocol.ProtocolError):
+        protocol.FrameReader().feed(data)
+
+
+@pytest.mark.parametrize("msg_type, payload", [
+    (protocol.MOVE, b"\x01\x02\x03"),
+    (protocol.MOVE, struct.pack("!H", 12 | (28 << 6) | (7 << 12))),
+    (protocol.GAME_OVER, b"\x01"),
+    (protocol.SYNC, b"\xff\xfe"),
+    (99, b""),
+])
+def test_decode_bad_payload(msg_type, payload):
+    with pytest.raises(protocol.ProtocolError):
+        protocol.decode(msg_type, payload)
+
+
+def test_read_frame():
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(protocol.batch(protocol.move(chess.Move.from_uci("e2e4")), protocol.reject(2)))
+        reader.feed_eof()
+        assert await protocol.read_frame(reader) == (protocol.MOVE, (chess.Move.from_uci("e2e4"),))
+        assert await protocol.read_raw_frame(reader) == (protocol.REJECT, b"\x02")
+        with pytest.raises(asyncio.IncompleteReadError):
+            await protocol.read_frame(reader)
+
+    asyncio.run(run())